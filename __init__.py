@@ -13,6 +13,9 @@
 
 from dataframe_utilities import get_series_from_shot as _get_singleshot
 from dataframe_utilities import dict_diff
+from dataframe_snapshot import read_snapshot as _read_snapshot
+from dataframe_store import DataFrameStore as _DataFrameStore
+from dataset_proxy import DatasetProxy
 import os
 import urllib
 import urllib2
@@ -20,10 +23,14 @@ import socket
 import pickle as pickle
 import inspect
 import sys
+import contextlib
+import collections
 
 import labscript_utils.h5_lock, h5py
 import pandas
-from numpy import array, ndarray
+from numpy import array, asarray, ndarray, empty, memmap
+from numpy.lib.format import open_memmap
+from multiprocessing.pool import ThreadPool
 import types
 
 from zprocess import zmq_get
@@ -62,131 +69,464 @@ class _RoutineStorage(object):
 
 routine_storage = _RoutineStorage()
 
+# Bounded caches for analysis routines that persist from one run to the next,
+# with decorators for memoising expensive setup. See lyse/cache.py:
+from lyse import cache
 
-def data(filepath=None, host='localhost', timeout=5):
+# When running in batch mode (python -m lyse batch), there is no lyse server
+# to get the dataframe from, and data() reads from this DataFrameStore
+# instead:
+_local_store = None
+
+
+def _is_local_host(host):
+    return host in ('localhost', '127.0.0.1', '::1', socket.gethostname())
+
+
+def _get_dataframe(host, timeout, read_only=False):
+    """Get the dataframe from the lyse server. Clients on the same host as
+    the server ask for the path of a snapshot of the dataframe on disk,
+    which they can memory-map rather than having the whole dataframe
+    pickled to them, read-only if read_only is True. Other clients, or
+    clients of a server that doesn't support snapshots, get it pickled."""
+    port = 42519
+    if _is_local_host(host):
+        for attempt in range(2):
+            response = zmq_get(port, host, {'get dataframe': {'transport': 'mmap'}}, timeout)
+            if not isinstance(response, dict):
+                # Server does not support snapshots:
+                break
+            try:
+                return _read_snapshot(response['snapshot'], read_only)
+            except (IOError, OSError):
+                # The snapshot was deleted before we could read it, because
+                # the dataframe changed several times in the meantime. Ask
+                # again, and if that fails too, or the snapshot is not
+                # private to this user, have the dataframe pickled instead:
+                continue
+    return zmq_get(port, host, 'get dataframe', timeout)
+
+
+def _index_dataframe(df):
+    """Index the dataframe by sequence and run time, in-place"""
+    try:
+        padding = ('',)*(df.columns.nlevels - 1)
+        df.set_index([('sequence',) + padding,('run time',) + padding], inplace=True, drop=False)
+        df.index.names = ['sequence', 'run time']
+        # df.set_index(['sequence', 'run time'], inplace=True, drop=False)
+    except KeyError:
+        # Empty dataframe?
+        pass
+    df.sort_index(inplace=True)
+
+
+def data(filepath=None, host='localhost', timeout=5, since=None,
+         columns=None, sequence=None, filter=None, last_n=None, read_only=False):
+    """Return the data of a single shot as a pandas Series if filepath is
+    given, otherwise the dataframe of all shots from lyse.
+
+    The dataframe can be limited to the given columns (which always include
+    sequence and run time), to rows from the given sequence or list of
+    sequences, to rows matching filter, and to the last_n of those rows.
+    filter is a (column, operator, value) triple such as ('detuning', '>',
+    2e6), or a list of them that must all be true. The operators are ==, !=,
+    <, <=, >, >= and in. The selection is done by lyse before the dataframe
+    is sent, so selecting only what is needed makes fetching much faster
+    when there are many shots.
+
+    If read_only is True and lyse is running on this computer, the whole
+    dataframe's numeric columns are memory-mapped from a file written by
+    lyse rather than copied into memory, which is faster and uses less
+    memory when there are many shots. However, they then can't be modified
+    in place, and the dataframe's columns are grouped by datatype rather
+    than sorted, so it can't be sliced by ranges of column names.
+
+    If since is given, only what has changed in lyse's dataframe since then
+    is fetched, and (changes, token) is returned. since should be 0 for the
+    first call, and the token returned by the previous call thereafter.
+    changes is a dictionary as returned by DataFrameStore.get_changes(). If
+    changes['reset'] is True, it contains all rows and columns rather than
+    only those that changed. IncrementalDataFrame uses this to keep a local
+    copy of the dataframe up to date."""
     if filepath is not None:
         return _get_singleshot(filepath)
+    selection = {}
+    for name, value in [('columns', columns), ('sequence', sequence), ('filter', filter), ('last_n', last_n)]:
+        if value is not None:
+            selection[name] = value
+    port = 42519
+    if since is not None:
+        if selection:
+            raise ValueError('since cannot be used with columns, sequence, filter or last_n')
+        if _local_store is not None:
+            changes = _local_store.get_changes(since or None)
+        else:
+            changes = zmq_get(port, host, {'get dataframe': {'since': since or None}}, timeout)
+        if not isinstance(changes, dict):
+            raise RuntimeError('lyse server does not support incremental fetches: %s' % str(changes))
+        return changes, changes['token']
+    if _local_store is not None:
+        df = _local_store.select(**selection)
+    elif selection:
+        df = zmq_get(port, host, {'get dataframe': selection}, timeout)
+        if not isinstance(df, pandas.DataFrame):
+            raise ValueError(str(df))
     else:
-        port = 42519
-        df = zmq_get(port, host, 'get dataframe', timeout)
-        try:
-            padding = ('',)*(df.columns.nlevels - 1)
-            df.set_index([('sequence',) + padding,('run time',) + padding], inplace=True, drop=False)
-            df.index.names = ['sequence', 'run time']
-            # df.set_index(['sequence', 'run time'], inplace=True, drop=False)
-        except KeyError:
-            # Empty dataframe?
-            pass
-        df.sort_index(inplace=True)
-        return df
-        
+        df = _get_dataframe(host, timeout, read_only)
+    _index_dataframe(df)
+    return df
+
+
+class IncrementalDataFrame(object):
+    """A local copy of lyse's dataframe that is kept up to date by fetching
+    only the rows and columns that have changed since it was last updated.
+    For use in multishot routines that fetch the dataframe after every shot,
+    store an instance in lyse.routine_storage so that it persists from one
+    run to the next:
+
+        if not hasattr(lyse.routine_storage, 'data'):
+            lyse.routine_storage.data = lyse.IncrementalDataFrame()
+        df = lyse.routine_storage.data.update()
+    """
+    def __init__(self, host='localhost', timeout=5):
+        self.host = host
+        self.timeout = timeout
+        self.store = _DataFrameStore()
+        self.token = 0
+        # The dataframe returned by the last update:
+        self.df = None
+
+    def update(self):
+        """Fetch changes from lyse and return the updated dataframe, indexed
+        and sorted as returned by data(). If the only changes are new rows,
+        only those are converted to a DataFrame and indexed, and they are
+        appended to the previous dataframe. Otherwise the dataframe is
+        rebuilt. Appending still copies the previous dataframe, as pandas
+        does, but this is much faster than rebuilding it.
+
+        The returned dataframe is the one the next update appends to, so it
+        should not be modified. Copy it first if need be."""
+        changes, self.token = data(host=self.host, timeout=self.timeout, since=self.token)
+        nrows = 0 if self.df is None else len(self.df)
+        self.store.apply_changes(changes)
+        if (self.df is not None and not changes['reset'] and list(self.df.index.names) == ['sequence', 'run time']
+                and set(self.df.columns) == set(self.store.columns) and not (changes['indices'] < nrows).any()):
+            n_new = len(self.store) - nrows
+            if n_new:
+                new_rows = self.store.select(last_n=n_new)
+                _index_dataframe(new_rows)
+                df = pandas.concat([self.df, new_rows])
+                if not df.index.is_monotonic_increasing:
+                    # Shots that arrived out of order:
+                    df.sort_index(inplace=True)
+                self.df = df
+        else:
+            self.df = self.store.select()
+            _index_dataframe(self.df)
+        return self.df
+
+
+def submit_shots(filepaths, host='localhost', timeout=30):
+    """Send a list of shot files to lyse to be added to its dataframe, in a
+    single request, which lyse queues all at once and reads as one batch.
+    This is much faster than submitting many shots one at a time. The
+    filepaths are converted to lab-wide paths as runmanager does, so that
+    lyse on another computer can find them. Returns the number of shots
+    accepted and the number rejected, as a tuple. Shots are only rejected if
+    they are not filepaths; errors reading shot files are reported by lyse
+    when it reads them, as for shots submitted by runmanager."""
+    import labscript_utils.shared_drive as shared_drive
+    port = 42519
+    filepaths = [shared_drive.path_to_agnostic(filepath) for filepath in filepaths]
+    response = zmq_get(port, host, {'filepaths': filepaths}, timeout)
+    if isinstance(response, dict):
+        return response['accepted'], response['rejected']
+    # A lyse server that doesn't support submitting lists of shots:
+    accepted = 0
+    for filepath in filepaths:
+        response = zmq_get(port, host, {'filepath': filepath}, timeout)
+        if response != 'added successfully':
+            raise RuntimeError(str(response))
+        accepted += 1
+    return accepted, 0
+
+
 def globals_diff(run1, run2, group=None):
     return dict_diff(run1.get_globals(group), run2.get_globals(group))
  
 class Run(object):
+    """A shot file, for reading data from and saving results to. Every call
+    opens and closes the file, unless the Run is used as a context manager:
+
+        with lyse.Run(lyse.path) as run:
+            run.save_result('x', x)
+            ...
+
+    in which case the file is opened once on entering the with block, all
+    reads use the open file, and saved results are kept in memory and
+    written all at once, on leaving the with block or when flush() is
+    called. This is much faster when many results are saved. The file (and
+    its lock, which other processes wait on to access it) is held open for
+    the duration of the with block, so it should only contain the work on
+    this shot. Saved results are written even if the block raises an
+    exception."""
+
+    # The open file and results waiting to be written, whilst being used as
+    # a context manager, and how many with blocks deep we are:
+    _h5_file = None
+    _pending_writes = None
+    _depth = 0
+
     def __init__(self,h5_path,no_write=False):
         self.no_write = no_write
         self.h5_path = h5_path
         if not self.no_write:
-            with h5py.File(h5_path) as h5_file:
-                if not 'results' in h5_file:
-                     h5_file.create_group('results')
-                     
-        try:
-            if not self.no_write:
+            try:
                 # The group were this run's results will be stored in the h5 file
                 # will be the name of the python script which is instantiating
                 # this Run object:
                 frame = inspect.currentframe()
                 __file__ = frame.f_back.f_locals['__file__']
                 self.group = os.path.basename(__file__).split('.py')[0]
-                with h5py.File(h5_path) as h5_file:
-                    if not self.group in h5_file['results']:
-                         h5_file['results'].create_group(self.group)
-        except KeyError:
-            # sys.stderr.write('Warning: to write results, call '
-            # 'Run.set_group(groupname), specifying the name of the group '
-            # 'you would like to save results to. This normally comes from '
-            # 'the filename of your script, but since you\'re in interactive '
-            # 'mode, there is no scipt name. Opening in read only mode for '
-            # 'the moment.\n')
-            self.no_write = True
-            
+            except KeyError:
+                # sys.stderr.write('Warning: to write results, call '
+                # 'Run.set_group(groupname), specifying the name of the group '
+                # 'you would like to save results to. This normally comes from '
+                # 'the filename of your script, but since you\'re in interactive '
+                # 'mode, there is no scipt name. Opening in read only mode for '
+                # 'the moment.\n')
+                self.no_write = True
+            with h5py.File(h5_path) as h5_file:
+                if not 'results' in h5_file:
+                     h5_file.create_group('results')
+                if not self.no_write and not self.group in h5_file['results']:
+                     h5_file['results'].create_group(self.group)
+
+    def __enter__(self):
+        if not self._depth:
+            self._h5_file = h5py.File(self.h5_path, 'r' if self.no_write else 'a')
+            self._pending_writes = collections.OrderedDict()
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if not self._depth:
+            try:
+                self.flush()
+            finally:
+                self._h5_file.close()
+                self._h5_file = None
+                self._pending_writes = None
+
+    def flush(self):
+        """Write any results saved since entering the with block or the last
+        call to flush(). Does nothing if the Run is not being used as a
+        context manager, since results are then written immediately."""
+        if not self._pending_writes:
+            return
+        for (kind, group, name), (value, options) in self._pending_writes.items():
+            if kind == 'attribute':
+                self._write_result(self._h5_file, name, value, group, True)
+            else:
+                self._write_result_array(self._h5_file, name, value, group, True, **options)
+        self._pending_writes.clear()
+
+    @contextlib.contextmanager
+    def _file(self):
+        """Context manager for a h5py.File of the shot file, which is the
+        open file if the Run is being used as a context manager"""
+        if self._h5_file is not None:
+            yield self._h5_file
+        else:
+            with h5py.File(self.h5_path) as h5_file:
+                yield h5_file
+
     def set_group(self, groupname):
         self.group = groupname
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             if not self.group in h5_file['results']:
                  h5_file['results'].create_group(self.group)
         self.no_write = False
 
     def trace_names(self):
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             try:
                 return h5_file['data']['traces'].keys()
             except KeyError:
                 return []
 
     def get_trace(self,name):
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             if not name in h5_file['data']['traces']:
                 raise Exception('The trace \'%s\' doesn not exist'%name)
             trace = h5_file['data']['traces'][name]
             return array(trace['t'],dtype=float),array(trace['values'],dtype=float)         
 
     def get_result_array(self,group,name):
-        with h5py.File(self.h5_path) as h5_file:
+        if self._pending_writes:
+            # Results saved but not yet written:
+            try:
+                data, _ = self._pending_writes['dataset', 'results/' + group, name]
+            except KeyError:
+                pass
+            else:
+                return array(data)
+        with self._file() as h5_file:
             if not group in h5_file['results']:
                 raise Exception('The result group \'%s\' doesn not exist'%group)
             if not name in h5_file['results'][group]:
                 raise Exception('The result array \'%s\' doesn not exist'%name)
             return array(h5_file['results'][group][name])
-            
-    def save_result(self, name, value, group=None, overwrite=True):
-        if self.no_write:
-            raise Exception('This run is read-only. '
-                            'You can\'t save results to runs through a '
-                            'Sequence object. Per-run analysis should be done '
-                            'in single-shot analysis routines, in which a '
-                            'single Run object is used')
-        with h5py.File(self.h5_path,'a') as h5_file:
-            if not group:
-                # Save to analysis results group by default
-                group = 'results/' + self.group
-            elif not group in h5_file:
-                # Create the group if it doesn't exist
-                h5_file.create_group(group) 
-            if name in h5_file[group].attrs.keys() and not overwrite:
-                raise Exception('Attribute %s exists in group %s. ' \
-                                'Use overwrite=True to overwrite.' % (name, group))                   
-            h5_file[group].attrs.modify(name, value)
-        
-    def save_result_array(self, name, data, group=None, overwrite=True, keep_attrs=False):
+
+    def _check_writable(self):
         if self.no_write:
             raise Exception('This run is read-only. '
                             'You can\'t save results to runs through a '
                             'Sequence object. Per-run analysis should be done '
                             'in single-shot analysis routines, in which a '
                             'single Run object is used')
-        with h5py.File(self.h5_path, 'a') as h5_file:
-            attrs = {}
-            if not group:
-                # Save dataset to results group by default
-                group = 'results/' + self.group
-            elif not group in h5_file:
-                # Create the group if it doesn't exist
-                h5_file.create_group(group) 
-            if name in h5_file[group]:
-                if overwrite:
-                    # Overwrite if dataset already exists
-                    if keep_attrs:
-                        attrs = dict(h5_file[group][name].attrs)
-                    del h5_file[group][name]
+
+    def save_result(self, name, value, group=None, overwrite=True):
+        self._check_writable()
+        if self._h5_file is None:
+            with h5py.File(self.h5_path,'a') as h5_file:
+                self._write_result(h5_file, name, value, group, overwrite)
+            return
+        if not group:
+            group = 'results/' + self.group
+        if not overwrite and (('attribute', group, name) in self._pending_writes or
+                              group in self._h5_file and name in self._h5_file[group].attrs):
+            raise Exception('Attribute %s exists in group %s. ' \
+                            'Use overwrite=True to overwrite.' % (name, group))
+        self._pending_writes['attribute', group, name] = value, {}
+
+    def _write_result(self, h5_file, name, value, group, overwrite):
+        if not group:
+            # Save to analysis results group by default
+            group = 'results/' + self.group
+        elif not group in h5_file:
+            # Create the group if it doesn't exist
+            h5_file.create_group(group) 
+        if name in h5_file[group].attrs.keys() and not overwrite:
+            raise Exception('Attribute %s exists in group %s. ' \
+                            'Use overwrite=True to overwrite.' % (name, group))                   
+        h5_file[group].attrs.modify(name, value)
+
+    def save_result_array(self, name, data, group=None, overwrite=True, keep_attrs=False,
+                          chunks=None, compression=None, compression_opts=None, shuffle=None,
+                          in_place=True):
+        """Save an array as a dataset in this routine's results group, or
+        the given group. chunks, compression, compression_opts and shuffle
+        are passed to h5py's create_dataset() to choose how the dataset is
+        stored, for example compression='gzip' for large, compressible
+        arrays. By default datasets are stored contiguously and
+        uncompressed, which is fastest for small arrays and allows them to
+        be memory-mapped.
+
+        If the dataset exists and overwrite is True, and the existing
+        dataset has the same shape and datatype, and the same storage
+        options if any are given, the new data is written into it in place,
+        unless in_place is False. Otherwise the existing dataset is deleted
+        and a new one created, which leaves the space it used in the file
+        unused, see repack(). The dataset's attributes are kept only if
+        keep_attrs is True, either way."""
+        self._check_writable()
+        options = dict(keep_attrs=keep_attrs, chunks=chunks, compression=compression,
+                       compression_opts=compression_opts, shuffle=shuffle, in_place=in_place)
+        if self._h5_file is None:
+            with h5py.File(self.h5_path, 'a') as h5_file:
+                self._write_result_array(h5_file, name, data, group, overwrite, **options)
+            return
+        if not group:
+            group = 'results/' + self.group
+        if not overwrite and (('dataset', group, name) in self._pending_writes or
+                              group in self._h5_file and name in self._h5_file[group]):
+            raise Exception('Dataset %s exists. Use overwrite=True to overwrite.' % 
+                             group + '/' + name)
+        # Copy the data, so that it is saved as it is now even if the caller
+        # modifies it before it is written:
+        self._pending_writes['dataset', group, name] = array(data), options
+
+    def _write_result_array(self, h5_file, name, data, group, overwrite, keep_attrs=False,
+                            chunks=None, compression=None, compression_opts=None, shuffle=None,
+                            in_place=True):
+        attrs = {}
+        if not group:
+            # Save dataset to results group by default
+            group = 'results/' + self.group
+        elif not group in h5_file:
+            # Create the group if it doesn't exist
+            h5_file.create_group(group) 
+        if name in h5_file[group]:
+            if overwrite:
+                dataset = h5_file[group][name]
+                if in_place and _can_write_in_place(dataset, data, chunks, compression,
+                                                    compression_opts, shuffle):
+                    if not keep_attrs:
+                        for key in list(dataset.attrs):
+                            del dataset.attrs[key]
+                    dataset[...] = data
+                    return
+                # Overwrite if dataset already exists
+                if keep_attrs:
+                    attrs = dict(dataset.attrs)
+                del h5_file[group][name]
+            else:
+                raise Exception('Dataset %s exists. Use overwrite=True to overwrite.' % 
+                                 group + '/' + name)
+        h5_file[group].create_dataset(name, data=data, chunks=chunks, compression=compression,
+                                      compression_opts=compression_opts, shuffle=shuffle)
+        for key, val in attrs.items():
+            h5_file[group][name].attrs[key] = val
+
+    def repack(self):
+        """Rewrite the shot file without the space left unused by deleted
+        and overwritten datasets, which HDF5 never reclaims, so that shot
+        files reanalysed many times don't keep growing. The contents are
+        copied to a new file, which then replaces the shot file. The shot
+        file's lock is held throughout, so other processes using h5_lock
+        can't write to it between the copy and the replacement. Returns the
+        number of bytes reclaimed.
+
+        Object references stored in the file are copied unchanged, and so
+        will not refer to the copied objects."""
+        import zprocess.locking
+        import labscript_utils.shared_drive as shared_drive
+        if self._h5_file is not None:
+            raise Exception('Cannot repack whilst the Run is in use in a with block')
+        temp_path = self.h5_path + '.repack'
+        backup_path = self.h5_path + '.repack_backup'
+        # The same lock h5_lock acquires when the file is opened, which is
+        # re-entrant, so the file can still be opened whilst holding it:
+        lock = zprocess.locking.Lock(shared_drive.path_to_agnostic(self.h5_path))
+        try:
+            with lock:
+                size = os.path.getsize(self.h5_path)
+                with h5py.File(self.h5_path, 'r') as h5_file:
+                    with h5py.File(temp_path, 'w') as new_file:
+                        for key, val in h5_file.attrs.items():
+                            new_file.attrs[key] = val
+                        for name in h5_file:
+                            h5_file.copy(name, new_file)
+                if os.name == 'nt':
+                    # os.rename() can't replace an existing file on Windows.
+                    # Move the original out of the way rather than deleting
+                    # it, so that it is never lost if the rename fails:
+                    os.rename(self.h5_path, backup_path)
+                    try:
+                        os.rename(temp_path, self.h5_path)
+                    except Exception:
+                        os.rename(backup_path, self.h5_path)
+                        raise
+                    os.remove(backup_path)
                 else:
-                    raise Exception('Dataset %s exists. Use overwrite=True to overwrite.' % 
-                                     group + '/' + name)
-            h5_file[group].create_dataset(name, data=data)
-            for key, val in attrs.items():
-                h5_file[group][name].attrs[key] = val
+                    # Atomically replaces the original:
+                    os.rename(temp_path, self.h5_path)
+                return size - os.path.getsize(self.h5_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
     def get_traces(self, *names):
         traces = []
@@ -222,7 +562,7 @@ class Run(object):
             self.save_result_array(name, value)
     
     def get_image(self,orientation,label,image):
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             if not 'images' in h5_file:
                 raise Exception('File does not contain any images')
             if not orientation in h5_file['images']:
@@ -233,6 +573,27 @@ class Run(object):
                 raise Exception('Image \'%s\' not found in file'%image)
             return array(h5_file['images'][orientation][label][image])
     
+    def image(self, orientation, label, image):
+        """Return a DatasetProxy of an image, which reads only the parts of
+        the image that are indexed, rather than all of it as get_image()
+        does. It can also be memory-mapped with its memmap() method, if it is
+        stored contiguously."""
+        return DatasetProxy(self, 'images/%s/%s/%s' % (orientation, label, image))
+
+    def trace(self, name):
+        """Return a DatasetProxy of a trace. Index it with 't' or 'values'
+        and a slice to read part of either, for example trace['values',
+        ::10] to read every tenth value."""
+        return DatasetProxy(self, 'data/traces/%s' % name)
+
+    def result_array(self, group, name):
+        """Return a DatasetProxy of a result array, which reads only the
+        parts of it that are indexed"""
+        if self._pending_writes and ('dataset', 'results/' + group, name) in self._pending_writes:
+            # Write results saved in this with block so that they can be read:
+            self.flush()
+        return DatasetProxy(self, 'results/%s/%s' % (group, name))
+
     def get_images(self,orientation,label, *images):
         results = []
         for image in images:
@@ -241,13 +602,13 @@ class Run(object):
         
     def get_all_image_labels(self):
         images_list = {}
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             for orientation in h5_file['/images'].keys():
                 images_list[orientation] = h5_file['/images'][orientation].keys()                
         return images_list                
     
     def get_image_attributes(self, orientation):
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             if not 'images' in h5_file:
                 raise Exception('File does not contain any images')
             if not orientation in h5_file['images']:
@@ -256,18 +617,18 @@ class Run(object):
         
     def get_globals(self,group=None):
         if not group:
-            with h5py.File(self.h5_path) as h5_file:
+            with self._file() as h5_file:
                 return dict(h5_file['globals'].attrs)
         else:
             try:
-                with h5py.File(self.h5_path) as h5_file:
+                with self._file() as h5_file:
                     return dict(h5_file['globals'][group].attrs)
             except KeyError:
                 return {}
 
     def get_globals_raw(self, group=None):
         globals_dict = {}
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             if group == None:
                 for obj in h5_file['globals'].values():
                     temp_dict = dict(obj.attrs)
@@ -308,7 +669,7 @@ class Run(object):
                 for key, val in temp_dict.items():
                     if val:
                         expansion_dict[key] = val
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             h5_file['globals'].visititems(append_expansion)
         return expansion_dict
                    
@@ -319,12 +680,12 @@ class Run(object):
                 temp_dict = dict(obj.attrs)
                 for key, val in temp_dict.items():
                     units_dict[key] = val
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             h5_file['globals'].visititems(append_units)
         return units_dict
 
     def globals_groups(self):
-        with h5py.File(self.h5_path) as h5_file:
+        with self._file() as h5_file:
             try:
                 return h5_file['globals'].keys()
             except KeyError:
@@ -334,7 +695,20 @@ class Run(object):
         return globals_diff(self, other_run, group)            
     
         
+# Default number of threads Sequence uses to read shot files concurrently:
+SEQUENCE_READ_THREADS = 8
+
+
 class Sequence(Run):
+    """Results of a multishot analysis, saved to h5_path, of the shots in
+    run_paths, which may be a list of shot files or a dataframe with a
+    'filepath' column. The bulk readers get_traces(), get_result_arrays()
+    and get_image() read the same datasets from every shot, in the order of
+    run_paths, into stacked arrays, reading several shot files at once with
+    a pool of threads. This overlaps the waiting to open and lock each
+    file, which otherwise dominates reading small datasets from many
+    shots."""
+
     def __init__(self,h5_path,run_paths):
         if isinstance(run_paths, pandas.DataFrame):
             run_paths = run_paths['filepath']
@@ -344,7 +718,8 @@ class Sequence(Run):
             if not 'results' in h5_file:
                  h5_file.create_group('results')
                  
-        self.runs = {path: Run(path,no_write=True) for path in run_paths}
+        self.run_paths = list(run_paths)
+        self.runs = {path: Run(path,no_write=True) for path in self.run_paths}
         
         # The group were the results will be stored in the h5 file will
         # be the name of the python script which is instantiating this
@@ -366,19 +741,152 @@ class Sequence(Run):
             self.no_write = True
         
     def get_trace(self,*args):
-        return {path:run.get_trace(*args) for run,path in self.runs.items()}
+        return {path:run.get_trace(*args) for path,run in self.runs.items()}
         
     def get_result_array(self,*args):
-        return {path:run.get_result_array(*args) for run,path in self.runs.items()}
-         
-    def get_traces(self,*args):
-        raise NotImplementedError('If you want to use this feature please ask me to implement it! -Chris')
-             
-    def get_result_arrays(self,*args):
-        raise NotImplementedError('If you want to use this feature please ask me to implement it! -Chris')
-     
-    def get_image(self,*args):
-        raise NotImplementedError('If you want to use this feature please ask me to implement it! -Chris')     
+        return {path:run.get_result_array(*args) for path,run in self.runs.items()}
+
+    def _read_stacked(self, dataset_paths, out=None, threads=None, progress=None, allocate=empty):
+        """Read the datasets at the given paths within every shot file and
+        return (run_paths, arrays), where arrays is a list with one array
+        per dataset, of shape (number of shots,) + the dataset's shape, with
+        the shots in the order of run_paths. The datasets must have the same
+        shape in every shot. Each dataset is read directly into its row of
+        the output arrays, which are allocated with allocate(shape, dtype)
+        with the datatypes of the datasets in the first shot, or can be
+        given as out, a list of C-contiguous arrays of the right shapes. If
+        progress is given, it is called as progress(n_done, n_shots) as each
+        shot is read."""
+        run_paths = list(self.run_paths)
+        if not run_paths:
+            raise Exception('This sequence has no runs')
+        if out is None:
+            out = []
+            with h5py.File(run_paths[0], 'r') as h5_file:
+                for dataset_path in dataset_paths:
+                    dataset = _get_dataset(h5_file, dataset_path)
+                    out.append(allocate((len(run_paths),) + dataset.shape, dataset.dtype))
+        elif len(out) != len(dataset_paths):
+            raise ValueError('out must have one array per dataset')
+        for array_out in out:
+            if len(array_out) != len(run_paths) or not array_out.flags.c_contiguous:
+                raise ValueError('Output arrays must be C-contiguous with one row per run')
+
+        def read_shot(i):
+            with h5py.File(run_paths[i], 'r') as h5_file:
+                for dataset_path, array_out in zip(dataset_paths, out):
+                    dataset = _get_dataset(h5_file, dataset_path)
+                    if dataset.shape != array_out.shape[1:]:
+                        raise ValueError('%s in %s has shape %s, expected %s' %
+                                         (dataset_path, run_paths[i], dataset.shape, array_out.shape[1:]))
+                    if dataset.size:
+                        dataset.read_direct(array_out[i])
+
+        pool = ThreadPool(min(threads or SEQUENCE_READ_THREADS, len(run_paths)))
+        try:
+            for n_done, _ in enumerate(pool.imap_unordered(read_shot, range(len(run_paths))), 1):
+                if progress is not None:
+                    progress(n_done, len(run_paths))
+        finally:
+            pool.close()
+            pool.join()
+        return run_paths, out
+
+    def get_traces(self, *names, **kwargs):
+        """Read the named traces from every shot and return (run_paths,
+        arrays), where arrays is [t1, values1, t2, values2, ...] as returned
+        by Run.get_traces(), but with each array of shape (number of shots,
+        number of samples). Keyword argument threads sets the number of
+        shot files read at once."""
+        threads = kwargs.pop('threads', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+        dataset_paths = ['data/traces/%s' % name for name in names]
+        run_paths, traces = self._read_stacked(dataset_paths, threads=threads)
+        arrays = []
+        for trace in traces:
+            arrays.extend([array(trace['t'], dtype=float), array(trace['values'], dtype=float)])
+        return run_paths, arrays
+
+    def get_result_arrays(self, group, *names, **kwargs):
+        """Read the named result arrays of the given results group from
+        every shot and return (run_paths, arrays), where arrays is a list
+        with one array per name, of shape (number of shots,) + the shape of
+        the result array. Keyword arguments: out, a list of preallocated
+        arrays to read into, one per name, and threads, the number of shot
+        files read at once."""
+        out = kwargs.pop('out', None)
+        threads = kwargs.pop('threads', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+        dataset_paths = ['results/%s/%s' % (group, name) for name in names]
+        return self._read_stacked(dataset_paths, out=out, threads=threads)
+
+    def get_image(self, orientation, label, image, out=None, threads=None):
+        """Read an image from every shot and return (run_paths, images),
+        where images has shape (number of shots,) + the shape of the image.
+        The images are read into out if it is given, which must be a
+        C-contiguous array of that shape. threads is the number of shot
+        files read at once. See also get_image_stack()."""
+        return self.get_image_stack(orientation, label, image, out=out, threads=threads)
+
+    def get_image_stack(self, orientation, label, image, out=None, mmap_path=None,
+                        threads=None, progress=None):
+        """Read an image from every shot into a single array and return
+        (run_paths, images), where images has shape (number of shots,) +
+        the shape of the image. Each image is read directly into its frame
+        of the stack, which is out if given, otherwise a new array, or if
+        mmap_path is given, a new .npy file at that path, memory-mapped. A
+        stack larger than memory can then be processed, and the file can be
+        reopened later with numpy.load(mmap_path, mmap_mode='r'). mmap_path
+        should be on a local disk with room for the stack. threads is the
+        number of shot files read at once, and progress, if given, is called
+        as progress(n_done, n_shots) as each shot is read."""
+        if out is not None:
+            out = [out]
+        allocate = empty
+        if mmap_path is not None:
+            def allocate(shape, dtype):
+                return open_memmap(mmap_path, mode='w+', dtype=dtype, shape=shape)
+        dataset_path = 'images/%s/%s/%s' % (orientation, label, image)
+        run_paths, (images,) = self._read_stacked([dataset_path], out=out, threads=threads,
+                                                  progress=progress, allocate=allocate)
+        if isinstance(images, memmap):
+            images.flush()
+        return run_paths, images
+
+
+def _can_write_in_place(dataset, data, chunks=None, compression=None, compression_opts=None,
+                        shuffle=None):
+    """Whether data can be written into an existing dataset rather than
+    replacing it: whether the data has the same shape and datatype as the
+    dataset, and any storage options given match the dataset's"""
+    data = asarray(data)
+    if isinstance(compression, int):
+        # A gzip compression level, as accepted by create_dataset():
+        compression, compression_opts = 'gzip', compression
+    if data.shape != dataset.shape or data.dtype != dataset.dtype or data.dtype.hasobject:
+        return False
+    if chunks is not None and chunks is not True and tuple(chunks) != dataset.chunks:
+        return False
+    if chunks is True and dataset.chunks is None:
+        return False
+    if compression is not None and compression != dataset.compression:
+        return False
+    if compression_opts is not None and compression_opts != dataset.compression_opts:
+        return False
+    if shuffle is not None and bool(shuffle) != dataset.shuffle:
+        return False
+    return True
+
+
+def _get_dataset(h5_file, dataset_path):
+    """Return the dataset at the given path in an open shot file, raising
+    an exception naming the file if it does not exist"""
+    try:
+        return h5_file[dataset_path]
+    except KeyError:
+        raise Exception('%s not found in %s' % (dataset_path, h5_file.filename))
 
 
 def figure_to_clipboard(figure=None, **kwargs):
@@ -11,7 +11,17 @@ import threading
 import signal
 import subprocess
 import time
-
+import ast
+import collections
+import traceback
+import multiprocessing.pool
+from ConfigParser import NoOptionError, NoSectionError
+
+# Headless batch analysis, without the GUI. This is dispatched before
+# anything GUI related is imported, so that it works without a display:
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'batch':
+    from lyse.batch import main
+    sys.exit(main(sys.argv[2:]))
 
 # Turn on our error catching for all subsequent imports
 import labscript_utils.excepthook
@@ -24,7 +34,6 @@ import labscript_utils.file_utils
 import numpy as np
 import labscript_utils.h5_lock
 import h5py
-import pandas
 import sip
 
 # Have to set PyQt API via sip before importing PyQt:
@@ -46,17 +55,17 @@ check_version('qtutils', '1.5.4', '2.0')
 check_version('zprocess', '1.1.7', '3.0')
 
 import zprocess.locking
-from zprocess import ZMQServer
 
 from labscript_utils.labconfig import LabConfig, config_prefix
 from labscript_utils.setup_logging import setup_logging
 from labscript_utils.qtwidgets.headerview_with_widgets import HorizontalHeaderViewWithWidgets
 import labscript_utils.shared_drive as shared_drive
 
-from lyse.dataframe_utilities import (concat_with_padding,
-                                      get_dataframe_from_shot,
-                                      get_dataframe_from_shots,
-                                      replace_with_padding)
+from lyse.dataframe_utilities import get_flat_dict_from_shot
+from lyse.dataframe_store import DataFrameStore
+from lyse.shot_cache import ShotMetadataCache
+from lyse.dataframe_snapshot import SnapshotWriter
+from lyse.zmq_server import ThreadPoolZMQServer
 
 from qtutils import inmain_decorator, UiLoader, DisconnectContextManager
 from qtutils.outputbox import OutputBox
@@ -82,6 +91,15 @@ def set_win_appusermodel(window_id):
     set_appusermodel(window_id, appids['lyse'], icon_path, relaunch_command, relaunch_display_name)
 
 
+def get_config_option(exp_config, section, option, default):
+    """Return an optional setting from the labconfig, or the given default
+    if it is not present"""
+    try:
+        return exp_config.get(section, option)
+    except (NoSectionError, NoOptionError):
+        return default
+
+
 @inmain_decorator()
 def error_dialog(message):
     QtGui.QMessageBox.warning(app.ui, 'lyse', message)
@@ -164,32 +182,110 @@ def scientific_notation(x, sigfigs=4, mode='eng'):
     return result
 
 
-class WebServer(ZMQServer):
+class WebServer(ThreadPoolZMQServer):
+    """Serves the dataframe to analysis routines and accepts shots from
+    runmanager. Requests for the dataframe are handled concurrently by a
+    pool of threads, reading from the DataFrameStore's cached DataFrame or
+    snapshots of it, which are never modified once made. Shot submissions
+    and other cheap requests are answered immediately, so that they are
+    never held up behind large requests for the dataframe."""
+
+    def __init__(self, port, *args, **kwargs):
+        # Snapshots of the dataframe for clients on the same host, which
+        # they can memory-map instead of having it pickled to them. Clients
+        # are sent the path of each snapshot:
+        self.snapshot_writer = SnapshotWriter()
+        ThreadPoolZMQServer.__init__(self, port, *args, **kwargs)
+
+    def shutdown(self):
+        ThreadPoolZMQServer.shutdown(self)
+        self.snapshot_writer.close()
+
+    def is_immediate(self, request_data):
+        return self.request_name(request_data) != 'get dataframe'
+
+    def request_name(self, request_data):
+        if isinstance(request_data, dict):
+            for name in ['get dataframe', 'filepath', 'filepaths']:
+                if name in request_data:
+                    return name
+        return ThreadPoolZMQServer.request_name(self, request_data)
 
     def handler(self, request_data):
         logger.info('WebServer request: %s' % str(request_data))
         if request_data == 'hello':
             return 'hello'
+        elif request_data == 'stats':
+            stats = self.get_stats()
+            stats['incoming_queue_depth'] = app.filebox.incoming_queue.qsize()
+            return stats
         elif request_data == 'get dataframe':
-            # convert_objects() picks fixed datatypes for columns that are
-            # compatible with fixed datatypes, dramatically speeding up
-            # pickling. But we don't impose fixed datatypes earlier than now
-            # because the user is free to use mixed datatypes in a column, and
-            # we won't want to prevent values of a different type being added
-            # in the future. All kwargs False because we don't want to coerce
-            # strings to numbers or anything - just choose the correct
-            # datatype for columns that are already a single datatype:
-            return app.filebox.shots_model.dataframe.convert_objects(
-                       convert_dates=False, convert_numeric=False, convert_timedeltas=False)
+            return self.get_dataframe({})
         elif isinstance(request_data, dict):
+            if 'get dataframe' in request_data:
+                return self.get_dataframe(request_data['get dataframe'])
             if 'filepath' in request_data:
                 h5_filepath = shared_drive.path_to_local(request_data['filepath'])
                 if not (isinstance(h5_filepath, unicode) or isinstance(h5_filepath, str)):
                     raise AssertionError(str(type(h5_filepath)) + ' is not str or unicode')
                 app.filebox.incoming_queue.put(h5_filepath)
                 return 'added successfully'
+            if 'filepaths' in request_data:
+                return self.add_files(request_data['filepaths'])
         return ("error: operation not supported. Recognised requests are:\n "
-                "'get dataframe'\n 'hello'\n {'filepath': <some_h5_filepath>}")
+                "'get dataframe'\n {'get dataframe': {'transport': 'mmap'}}\n "
+                "{'get dataframe': {'since': <token>}}\n "
+                "{'get dataframe': {'columns': [...], 'sequence': ..., 'filter': [...], 'last_n': ...}}\n "
+                "'hello'\n 'stats'\n {'filepath': <some_h5_filepath>}\n "
+                "{'filepaths': [<some_h5_filepath>, ...]}")
+
+    def add_files(self, filepaths):
+        """Queue a list of shot files to be added to the dataframe as a
+        single batch. Entries that are not filepaths are rejected. Returns
+        the number of files accepted and rejected."""
+        if not isinstance(filepaths, (list, tuple)):
+            return 'error: filepaths must be a list'
+        accepted = []
+        for filepath in filepaths:
+            if isinstance(filepath, (str, unicode)):
+                h5_filepath = shared_drive.path_to_local(filepath)
+                if isinstance(h5_filepath, (str, unicode)):
+                    accepted.append(h5_filepath)
+        if accepted:
+            app.filebox.incoming_queue.put(accepted)
+        return {'accepted': len(accepted), 'rejected': len(filepaths) - len(accepted)}
+
+    def get_dataframe(self, options):
+        """Return the dataframe, or if options['transport'] is 'mmap', the
+        path of a snapshot of it that a client on the same host can read with
+        dataframe_snapshot.read_snapshot(), or if options['since'] is a token
+        from a previous request (or None), the changes to it since then as
+        returned by DataFrameStore.get_changes(). If any of the options
+        'columns', 'sequence', 'filter' or 'last_n' are given, only the
+        selected part of the dataframe is returned, as selected by
+        DataFrameStore.select()."""
+        store = app.filebox.shots_model.store
+        if 'since' in options:
+            # Only what changed since the client's token:
+            return store.get_changes(options['since'])
+        selection = {}
+        for name in ['columns', 'sequence', 'filter', 'last_n']:
+            if options.get(name) is not None:
+                selection[str(name)] = options[name]
+        if selection:
+            # Only the requested rows and columns:
+            try:
+                return store.select(**selection)
+            except (KeyError, ValueError) as e:
+                return 'error: %s' % str(e)
+        if options.get('transport') == 'mmap':
+            return {'snapshot': self.snapshot_writer.get_snapshot(store)}
+        # The store's columns already have fixed datatypes wherever their
+        # values are all of a single numeric type, which dramatically speeds
+        # up pickling. Since a column's datatype is promoted whenever a value
+        # of a different type is added, users are still free to use mixed
+        # datatypes in a column, which are stored as objects:
+        return app.filebox.shots_model.dataframe
 
 
 class LyseMainWindow(QtGui.QMainWindow):
@@ -203,11 +299,77 @@ class LyseMainWindow(QtGui.QMainWindow):
         return result
 
 
+def get_routine_references(filepath):
+    """Returns the set of names an analysis routine may read results from.
+    This is every string literal in the routine, which catches the group
+    names passed to Run.get_result_array() and used to index the series from
+    lyse.data(), as well as any names listed in a module-level
+    __lyse_depends__ list or tuple in the routine. Returns None if the
+    routine cannot be parsed, in which case it should be assumed to depend on
+    everything."""
+    try:
+        with open(filepath) as f:
+            module = ast.parse(f.read(), filepath)
+    except (IOError, SyntaxError, TypeError):
+        return None
+    names = set(node.s for node in ast.walk(module) if isinstance(node, ast.Str))
+    for node in module.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == '__lyse_depends__'
+                                                for target in node.targets):
+            try:
+                names.update(ast.literal_eval(node.value))
+            except (ValueError, TypeError):
+                return None
+    return names
+
+
+def get_routine_workers(filepath):
+    """Returns the number of worker processes a singleshot analysis routine
+    should be run in, as set by a module-level __lyse_workers__ = N in the
+    routine. Shots are then analysed by up to N workers at once, so only
+    routines that are safe to run on several shots at the same time should
+    set this. Returns 1 if it is not set or is invalid."""
+    try:
+        with open(filepath) as f:
+            module = ast.parse(f.read(), filepath)
+    except (IOError, SyntaxError, TypeError):
+        return 1
+    n_workers = 1
+    for node in module.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == '__lyse_workers__'
+                                                for target in node.targets):
+            try:
+                n_workers = int(ast.literal_eval(node.value))
+            except (ValueError, TypeError):
+                return 1
+    return max(1, n_workers)
+
+
+class ShotState(object):
+    """The progress of a routine box's analysis of a single shot"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        # The routines that have finished with this shot successfully:
+        self.done = set()
+        # The routines that are currently running on this shot:
+        self.running = set()
+        # Whether any routine failed on this shot:
+        self.error = False
+
+
 class AnalysisRoutine(object):
 
-    def __init__(self, filepath, model, output_box_port):
+    def __init__(self, filepath, model, output_box_port, multishot=False):
         self.filepath = filepath
+        self.multishot = multishot
         self.shortname = os.path.basename(self.filepath)
+        # The name of the results group the routine saves to:
+        self.group_name = self.shortname.split('.py')[0]
+        # The names the routine references, and the modification time of the
+        # routine when they were determined:
+        self._references = None
+        self._references_mtime = None
         self.model = model
         self.output_box_port = output_box_port
 
@@ -219,7 +381,7 @@ class AnalysisRoutine(object):
         self.error = False
         self.done = False
 
-        self.to_worker, self.from_worker, self.worker = self.start_worker()
+        self.start_workers()
 
         # Make a row to put into the model:
         active_item =  QtGui.QStandardItem()
@@ -233,17 +395,43 @@ class AnalysisRoutine(object):
 
         self.exiting = False
 
-    def start_worker(self):
+    def start_workers(self):
+        """Start the worker processes for this analysis routine. Singleshot
+        routines may ask for more than one with __lyse_workers__, in which
+        case only the first worker shows plots, so that there is only one
+        window per figure."""
+        if self.multishot:
+            self.n_workers = 1
+        else:
+            self.n_workers = get_routine_workers(self.filepath)
+        self.workers = [self.start_worker(plots=(i == 0)) for i in range(self.n_workers)]
+        # Workers not currently analysing a shot. The lowest numbered idle
+        # worker is always used first, so that if shots are being analysed
+        # one at a time, the worker showing plots analyses all of them:
+        self.idle_workers = Queue.PriorityQueue()
+        for i, child_handles in enumerate(self.workers):
+            self.idle_workers.put((i, child_handles))
+
+    def start_worker(self, plots=True):
         # Start a worker process for this analysis routine:
         child_handles = zprocess.subprocess_with_queues('analysis_subprocess.py', self.output_box_port)
         to_worker, from_worker, worker = child_handles
-        # Tell the worker what script it with be executing:
-        to_worker.put(self.filepath)
+        # Tell the worker what script it with be executing, and whether to
+        # show plots:
+        to_worker.put([self.filepath, plots])
         return to_worker, from_worker, worker
 
     def do_analysis(self, filepath):
-        self.to_worker.put(['analyse', filepath])
-        signal, data = self.from_worker.get()
+        """Analyse a shot with the first idle worker, blocking until one is
+        available"""
+        idle_workers = self.idle_workers
+        i, child_handles = idle_workers.get()
+        to_worker, from_worker, worker = child_handles
+        try:
+            to_worker.put(['analyse', filepath])
+            signal, data = from_worker.get()
+        finally:
+            idle_workers.put((i, child_handles))
         if signal == 'error':
             return False
         elif signal == 'done':
@@ -251,6 +439,18 @@ class AnalysisRoutine(object):
         else:
             raise ValueError('invalid signal %s'%str(signal))
 
+    def get_references(self):
+        """The set of names of other routines this routine may read results
+        from, or None if not known. Cached until the file is modified."""
+        try:
+            mtime = os.path.getmtime(self.filepath)
+        except OSError:
+            return None
+        if mtime != self._references_mtime:
+            self._references = get_routine_references(self.filepath)
+            self._references_mtime = mtime
+        return self._references
+
     @inmain_decorator()
     def set_status(self, status):
         index = self.get_row_index()
@@ -308,37 +508,47 @@ class AnalysisRoutine(object):
         self.model.removeRow(index)
 
     def end_child(self, restart=False):
-        self.to_worker.put(['quit',None])
+        workers = [worker for _, _, worker in self.workers]
+        for to_worker, _, _ in self.workers:
+            to_worker.put(['quit',None])
         timeout_time = time.time() + 2
         self.exiting = True
         QtCore.QTimer.singleShot(50,
-            lambda: self.check_child_exited(self.worker, timeout_time, kill=False, restart=restart))
-
-    def check_child_exited(self, worker, timeout_time, kill=False, restart=False):
-        worker.poll()
-        if worker.returncode is None and time.time() < timeout_time:
+            lambda: self.check_child_exited(workers, timeout_time, kill=False, restart=restart))
+
+    def check_child_exited(self, workers, timeout_time, kill=False, restart=False):
+        for worker in workers:
+            worker.poll()
+        alive = [worker for worker in workers if worker.returncode is None]
+        if len(workers) == 1:
+            name = '%s worker'%self.shortname
+        else:
+            name = '%s workers'%self.shortname
+        if alive and time.time() < timeout_time:
             QtCore.QTimer.singleShot(50,
-                lambda: self.check_child_exited(worker, timeout_time, kill, restart))
+                lambda: self.check_child_exited(workers, timeout_time, kill, restart))
             return
-        elif worker.returncode is None:
+        elif alive:
             if not kill:
-                worker.terminate()
-                app.output_box.output('%s worker not responding.\n'%self.shortname)
+                for worker in alive:
+                    worker.terminate()
+                app.output_box.output('%s not responding.\n'%name)
                 timeout_time = time.time() + 2
                 QtCore.QTimer.singleShot(50,
-                    lambda: self.check_child_exited(worker, timeout_time, kill=True, restart=restart))
+                    lambda: self.check_child_exited(workers, timeout_time, kill=True, restart=restart))
                 return
             else:
-                worker.kill()
-                app.output_box.output('%s worker killed\n'%self.shortname, red=True)
+                for worker in alive:
+                    worker.kill()
+                app.output_box.output('%s killed\n'%name, red=True)
         elif kill:
-            app.output_box.output('%s worker terminated\n'%self.shortname, red=True)
+            app.output_box.output('%s terminated\n'%name, red=True)
         else:
-            app.output_box.output('%s worker exited cleanly\n'%self.shortname)
+            app.output_box.output('%s exited cleanly\n'%name)
 
         if restart:
-            self.to_worker, self.from_worker, self.worker = self.start_worker()
-            app.output_box.output('%s worker restarted\n'%self.shortname)
+            self.start_workers()
+            app.output_box.output('%s restarted\n'%name)
         self.exiting = False
 
 
@@ -412,6 +622,19 @@ class RoutineBox(object):
 
         self.logger = logging.getLogger('lyse.RoutineBox.%s'%('multishot' if multishot else 'singleshot'))
 
+        # Whether routines that do not depend on each other's results may run
+        # on the same shot at the same time. Otherwise each shot is analysed
+        # by one routine at a time, in the order of the list, though
+        # different routines may be busy with different shots at once. Off by
+        # default, since dependencies are only detected from string literals
+        # naming other routines' groups (or declared with __lyse_depends__),
+        # and a routine reading results saved under another group name, or
+        # one built at runtime, could otherwise read them before they are
+        # saved. Set concurrent_routines = True in the [lyse] section of the
+        # labconfig to enable it:
+        concurrent_routines = get_config_option(exp_config, 'lyse', 'concurrent_routines', 'False')
+        self.concurrent_routines = concurrent_routines.lower() in ['true', 'yes', 'on', '1']
+
         loader = UiLoader()
         loader.registerCustomWidget(TreeView)
         self.ui = loader.load('routinebox.ui')
@@ -464,6 +687,10 @@ class RoutineBox(object):
 
         self.routines = []
 
+        # Shots from the filebox and results from routines, for the analysis
+        # loop to act on:
+        self.events = Queue.Queue()
+
         self.connect_signals()
 
         self.analysis = threading.Thread(target = self.analysis_loop)
@@ -511,7 +738,7 @@ class RoutineBox(object):
             if filepath in [routine.filepath for routine in self.routines]:
                 app.output_box.output('Warning: Ignoring duplicate analysis routine %s\n'%filepath, red=True)
                 continue
-            routine = AnalysisRoutine(filepath, self.model, self.output_box_port)
+            routine = AnalysisRoutine(filepath, self.model, self.output_box_port, self.multishot)
             self.routines.append(routine)
         self.update_select_all_checkstate()
 
@@ -666,62 +893,146 @@ class RoutineBox(object):
                 routine.restart()
         self.update_select_all_checkstate()
 
-    def analysis_loop(self):
+    def forward_shots(self):
+        """Pass shots from the filebox to the analysis loop, so that the
+        analysis loop can wait on shots and routine results at once"""
         while True:
             filepath = self.from_filebox.get()
-            if self.multishot:
-                assert filepath is None
-                # TODO: get the filepath of the output h5 file:
-                # filepath = self.filechooserentry.get_text()
-            self.logger.info('got a file to process: %s'%filepath)
-            self.do_analysis(filepath)
-
-    def todo(self):
-        """How many analysis routines are not done?"""
-        return len([r for r in self.routines if r.enabled() and not r.done])
+            self.events.put(['shot', filepath])
 
-    def do_analysis(self, filepath):
-        """Run all analysis routines once on the given filepath,
-        which is a shot file if we are a singleshot routine box"""
-        for routine in self.routines:
-            routine.set_status('clear')
-        remaining = self.todo()
+    def analysis_loop(self):
+        """Analyse shots as they arrive, several at a time. Each routine
+        analyses shots in the order they arrived, and starts on a shot as soon
+        as it has finished the previous one and the routines it depends on
+        have finished with that shot. So a cheap routine near the top of the
+        list can move on to the next shot whilst an expensive one further
+        down is still busy with the last one. Routines with more than one
+        worker process start on as many shots at once as they have workers.
+        Results are reported to the filebox in the order the shots
+        arrived."""
+        forwarder = threading.Thread(target=self.forward_shots)
+        forwarder.daemon = True
+        forwarder.start()
+        # Shots currently being analysed, in the order they arrived:
+        shots = []
         error = False
-        while remaining:
-            self.logger.debug('%d routines left to do'%remaining)
-            for routine in self.routines:
-                if routine.enabled() and not routine.done:
-                    break
-            else:
-                routine = None
-            if routine is not None:
-                self.logger.info('running analysis routine %s'%routine.shortname)
-                routine.set_status('working')
-                success = routine.do_analysis(filepath)
+        while True:
+            event = self.events.get()
+            if event[0] == 'shot':
+                filepath = event[1]
+                if self.multishot:
+                    assert filepath is None
+                    # TODO: get the filepath of the output h5 file:
+                    # filepath = self.filechooserentry.get_text()
+                self.logger.info('got a file to process: %s'%filepath)
+                if not shots:
+                    for routine in self.routines:
+                        routine.set_status('clear')
+                shots.append(ShotState(filepath))
+            elif event[0] == 'result':
+                _, routine, filepath, success = event
+                shot = [s for s in shots if s.filepath == filepath and routine in s.running][0]
+                shot.running.remove(routine)
                 if success:
-                    routine.set_status('done')
-                    self.logger.debug('success')
+                    if not any(routine in s.running for s in shots):
+                        routine.set_status('done')
+                    shot.done.add(routine)
+                    self.logger.debug('%s: success on %s'%(routine.shortname, filepath))
                 else:
                     routine.set_status('error')
-                    self.logger.debug('failure')
+                    shot.error = True
+                    self.logger.debug('%s: failure on %s'%(routine.shortname, filepath))
+                    # Start no more routines, but let those already running finish:
                     error = True
+                if routine in self.routines:
+                    self.to_filebox.put(['progress', filepath, self.percent_done(shot)])
+            if not error:
+                self.start_routines(shots)
+            # Report shots that are complete, in the order they arrived:
+            while shots and not shots[0].error and self.percent_done(shots[0]) == 100:
+                shot = shots.pop(0)
+                self.to_filebox.put(['done', shot.filepath, 100.0])
+                self.logger.debug('completed analysis of %s'%shot.filepath)
+            if error and not any(shot.running for shot in shots):
+                # Everything that was running has finished. Give up on the
+                # remaining shots. Errors are reported first, so that the
+                # filebox pauses analysis before any incomplete shots leave
+                # its pipeline, rather than sending more shots to fill it:
+                for shot in shots:
+                    if shot.error:
+                        self.to_filebox.put(['error', shot.filepath, None])
+                for shot in shots:
+                    if not shot.error:
+                        self.to_filebox.put(['incomplete', shot.filepath, None])
+                shots = []
+                error = False
+
+    def percent_done(self, shot):
+        """The percentage of enabled routines that have finished with the
+        given shot"""
+        routines = [r for r in self.routines if r.enabled()]
+        if not routines:
+            return 100.0
+        done = len([r for r in routines if r in shot.done])
+        return 100*float(done)/len(routines)
+
+    def start_routines(self, shots):
+        """Start each enabled routine on the earliest shots it has not yet
+        analysed and is not already running on, up to as many shots at once
+        as it has workers, if the routines it depends on have finished with
+        those shots"""
+        routines = [r for r in self.routines if r.enabled()]
+        dependencies = self.get_dependencies(routines)
+        # The routines currently running, once for each shot they are
+        # running on:
+        running = [routine for shot in shots for routine in shot.running]
+        for routine in routines:
+            n_idle = routine.n_workers - running.count(routine)
+            for shot in shots:
+                if not n_idle:
                     break
-            # Race conditions here, but it's only for reporting percent done
-            # so it doesn't matter if it's wrong briefly:
-            remaining = self.todo()
-            total = len([r for r in self.routines if r.enabled()])
-            done = total - remaining
-            try:
-                status_percent = 100*float(done)/(remaining + done)
-            except ZeroDivisionError:
-                # All routines got deleted mid-analysis, we're done here:
-                status_percent = 100.0
-            self.to_filebox.put(['progress', status_percent])
-        if error:
-            self.to_filebox.put(['error', None])
-        else:
-            self.to_filebox.put(['done', 100.0])
-        self.logger.debug('completed analysis of %s'%filepath)
+                if routine in shot.done or routine in shot.running:
+                    continue
+                if not dependencies[routine] <= shot.done:
+                    # Shots must be started in order, so this routine can't
+                    # start any later ones either:
+                    break
+                self.logger.info('running analysis routine %s on %s'%(routine.shortname, shot.filepath))
+                routine.set_status('working')
+                shot.running.add(routine)
+                running.append(routine)
+                n_idle -= 1
+                thread = threading.Thread(target=self.run_routine, args=(routine, shot.filepath))
+                thread.daemon = True
+                thread.start()
+        self.logger.debug('%d routines running'%len(running))
+
+    def get_dependencies(self, routines):
+        """Returns a dict of each of the given routines to the set of
+        routines among them that it depends on. A routine depends on all
+        routines above it in the list, unless concurrent_routines is set, in
+        which case it depends only on those whose results group names it
+        references, or on all of them if its references cannot be determined.
+        Dependencies are never on routines further down the list, so the list
+        order is always a valid order to run them in."""
+        dependencies = {}
+        for i, routine in enumerate(routines):
+            references = routine.get_references()
+            if references is None or not self.concurrent_routines:
+                dependencies[routine] = set(routines[:i])
+            else:
+                dependencies[routine] = set(r for r in routines[:i] if r.group_name in references)
+        return dependencies
+
+    def run_routine(self, routine, filepath):
+        """Run a single routine on a shot and put the result in the events
+        queue. To be run in its own thread"""
+        try:
+            success = routine.do_analysis(filepath)
+        except Exception:
+            self.events.put(['result', routine, filepath, False])
+            raise
+        self.events.put(['result', routine, filepath, success])
 
     def reorder(self, order):
         assert len(order) == len(set(order)), 'ordering contains non-unique elements'
@@ -750,7 +1061,7 @@ class RoutineBox(object):
     def queue_dummy_routines(self):
         folder = os.path.abspath('test_routines')
         for filepath in ['hello.py', 'test.py']:
-            routine = AnalysisRoutine(os.path.join(folder, filepath), self.model, self.output_box_port)
+            routine = AnalysisRoutine(os.path.join(folder, filepath), self.model, self.output_box_port, self.multishot)
             self.routines.append(routine)
         self.update_select_all_checkstate()
 
@@ -1082,6 +1393,147 @@ class TableView(QtGui.QTableView):
         return result
 
 
+class ShotsTableModel(QtCore.QAbstractTableModel):
+    """A read-only Qt model of the shots in a DataFrameModel. Rather than
+    mirroring the dataframe into one QStandardItem per cell, cells are read
+    on demand from the DataFrameModel's DataFrameStore when the view asks for
+    them, which is only for visible cells. Formatted text is cached, and the
+    DataFrameModel is responsible for invalidating the cache and emitting
+    fine-grained dataChanged signals when cells change. Row and column counts
+    come from the DataFrameModel's status_percents and column_names, which it
+    must only modify between the appropriate begin/end calls."""
+
+    # Maximum number of formatted strings to keep. The view only ever asks
+    # for visible cells, so this is ample:
+    MAX_CACHED_CELLS = 20000
+
+    def __init__(self, dataframe_model):
+        QtCore.QAbstractTableModel.__init__(self)
+        self._dataframe_model = dataframe_model
+        # Formatted cell text, keyed by (row number, column name):
+        self._text_cache = {}
+        self._status_icon = QtGui.QIcon(':qtutils/fugue/tick')
+        self._status_header_icon = QtGui.QIcon(':qtutils/fugue/information')
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._dataframe_model.status_percents)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._dataframe_model.column_names)
+
+    def flags(self, index):
+        # Selectable but not editable:
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+
+    def format_value(self, value):
+        """Return the text to display for a value in the dataframe"""
+        if isinstance(value, float):
+            value_str = scientific_notation(value)
+        else:
+            value_str = str(value)
+        lines = value_str.splitlines()
+        if len(lines) > 1:
+            return lines[0] + ' ...'
+        return value_str
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        dataframe_model = self._dataframe_model
+        row, column = index.row(), index.column()
+        if column == dataframe_model.COL_STATUS:
+            if role == dataframe_model.ROLE_STATUS_PERCENT:
+                return dataframe_model.status_percents[row]
+            elif role == QtCore.Qt.DecorationRole:
+                return self._status_icon
+            return None
+        column_name = dataframe_model.column_names.get(column)
+        if not isinstance(column_name, tuple):
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            try:
+                return self._text_cache[row, column_name]
+            except KeyError:
+                pass
+            try:
+                value = dataframe_model.store.get_value(row, column_name)
+            except (KeyError, IndexError):
+                return None
+            text = self.format_value(value)
+            if len(self._text_cache) >= self.MAX_CACHED_CELLS:
+                self._text_cache.clear()
+            self._text_cache[row, column_name] = text
+            return text
+        elif role == QtCore.Qt.ToolTipRole:
+            try:
+                value = dataframe_model.store.get_value(row, column_name)
+            except (KeyError, IndexError):
+                return None
+            if column == dataframe_model.COL_FILEPATH:
+                return value
+            return repr(value)
+        elif role == QtCore.Qt.TextAlignmentRole and column != dataframe_model.COL_FILEPATH:
+            return QtCore.Qt.AlignCenter
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        dataframe_model = self._dataframe_model
+        if orientation == QtCore.Qt.Vertical:
+            if role == QtCore.Qt.DisplayRole:
+                n_digits = len(str(self.rowCount()))
+                try:
+                    filepath = dataframe_model.store.get_value(section, 'filepath')
+                except IndexError:
+                    return None
+                basename = os.path.splitext(os.path.basename(filepath))[0]
+                row_number_str = str(section).rjust(n_digits)
+                return '{}. | {}'.format(row_number_str, basename)
+            return None
+        if section == dataframe_model.COL_STATUS:
+            if role == QtCore.Qt.DecorationRole:
+                return self._status_header_icon
+            elif role == QtCore.Qt.ToolTipRole:
+                return 'status/progress of single-shot analysis'
+            return None
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            column_name = dataframe_model.column_names.get(section)
+            if not isinstance(column_name, tuple):
+                return None
+            return '\n'.join(column_name).strip()
+        return None
+
+    def clear_cache(self):
+        """Forget all formatted text, for use when rows have moved"""
+        self._text_cache.clear()
+
+    def update_cells(self, row, column_numbers):
+        """Discard cached text for the given cells and tell the view they
+        have changed, emitting one dataChanged signal per contiguous range of
+        columns"""
+        column_numbers = sorted(column_numbers)
+        if not column_numbers:
+            return
+        for column_number in column_numbers:
+            column_name = self._dataframe_model.column_names.get(column_number)
+            self._text_cache.pop((row, column_name), None)
+        range_start = range_end = column_numbers[0]
+        for column_number in column_numbers[1:] + [None]:
+            if column_number == range_end + 1:
+                range_end = column_number
+                continue
+            self.dataChanged.emit(self.index(row, range_start), self.index(row, range_end))
+            if column_number is not None:
+                range_start = range_end = column_number
+
+    def update_vertical_header(self):
+        if self.rowCount():
+            self.headerDataChanged.emit(QtCore.Qt.Vertical, 0, self.rowCount() - 1)
+
+
 class DataFrameModel(QtCore.QObject):
 
     COL_STATUS = 0
@@ -1095,7 +1547,32 @@ class DataFrameModel(QtCore.QObject):
         QtCore.QObject.__init__(self)
         self._view = view
         self.exp_config = exp_config
-        self._model = UneditableModel()
+
+        # This store will contain all the scalar data from the shot files
+        # that are currently open. A pandas DataFrame is only made from it
+        # when one is asked for:
+        self.store = DataFrameStore()
+        self.store.add_column(('filepath',))
+        # How many levels the dataframe's multiindex has:
+        self.nlevels = self.store.nlevels
+
+        # The analysis progress of each row:
+        self.status_percents = []
+
+        # Column indices to names and vice versa for fast lookup:
+        self.column_indices = {'__status': self.COL_STATUS, ('filepath', ''): self.COL_FILEPATH}
+        self.column_names = {self.COL_STATUS: '__status', self.COL_FILEPATH: ('filepath', '')}
+        self.columns_visible = {self.COL_STATUS: True, self.COL_FILEPATH: True}
+
+        # Shot filepaths to row indices for fast lookup. Rows in the
+        # dataframe store and in the Qt model are in the same order, so this
+        # is both the dataframe row and the model row:
+        self.row_indices = {}
+
+        # Whether or not a deleted column was visible at the time it was deleted (by name):
+        self.deleted_columns_visible = {}
+
+        self._model = ShotsTableModel(self)
 
         headerview_style = """
                            QHeaderView {
@@ -1122,33 +1599,12 @@ class DataFrameModel(QtCore.QObject):
         self._view.setItemDelegate(self._delegate)
         self._view.setSelectionBehavior(QtGui.QTableView.SelectRows)
         self._view.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
-
-        # This dataframe will contain all the scalar data
-        # from the shot files that are currently open:
-        index = pandas.MultiIndex.from_tuples([('filepath', '')])
-        self.dataframe = pandas.DataFrame({'filepath': []}, columns=index)
-        # How many levels the dataframe's multiindex has:
-        self.nlevels = self.dataframe.columns.nlevels
-
-        status_item = QtGui.QStandardItem()
-        status_item.setIcon(QtGui.QIcon(':qtutils/fugue/information'))
-        status_item.setToolTip('status/progress of single-shot analysis')
-        self._model.setHorizontalHeaderItem(self.COL_STATUS, status_item)
-
-        filepath_item = QtGui.QStandardItem('filepath')
-        filepath_item.setToolTip('filepath')
-        self._model.setHorizontalHeaderItem(self.COL_FILEPATH, filepath_item)
+        # All rows are the same height, so rows do not need resizing to their contents:
+        row_height = QtGui.QFontMetrics(self._view.font()).height() + ItemDelegate.EXTRA_ROW_HEIGHT
+        self._vertheader.setDefaultSectionSize(row_height)
 
         self._view.setColumnWidth(self.COL_STATUS, 70)
         self._view.setColumnWidth(self.COL_FILEPATH, 100)
-
-        # Column indices to names and vice versa for fast lookup:
-        self.column_indices = {'__status': self.COL_STATUS, ('filepath', ''): self.COL_FILEPATH}
-        self.column_names = {self.COL_STATUS: '__status', self.COL_FILEPATH: ('filepath', '')}
-        self.columns_visible = {self.COL_STATUS: True, self.COL_FILEPATH: True}
-
-        # Whether or not a deleted column was visible at the time it was deleted (by name):
-        self.deleted_columns_visible = {}
         
         # Make the actions for the context menu:
         self.action_remove_selected = QtGui.QAction(
@@ -1156,48 +1612,58 @@ class DataFrameModel(QtCore.QObject):
 
         self.connect_signals()
 
+    @property
+    def dataframe(self):
+        """A pandas DataFrame of the data in the store. Not to be modified."""
+        return self.store.to_dataframe()
+
     def connect_signals(self):
         self._view.customContextMenuRequested.connect(self.on_view_context_menu_requested)
         self.action_remove_selected.triggered.connect(self.on_remove_selection)
 
     def get_model_row_by_filepath(self, filepath):
-        filepath_colname = ('filepath',) + ('',) * (self.nlevels - 1)
-        possible_items = self._model.findItems(filepath, column=self.column_indices[filepath_colname])
-        if len(possible_items) > 1:
-            raise LookupError('Multiple items found')
-        elif not possible_items:
+        try:
+            return self.row_indices[filepath]
+        except KeyError:
             raise LookupError('No item found')
 
-        item = possible_items[0]
-        index = item.index()
-        return index.row()
+    def update_row_indices(self):
+        """Rebuild the filepath to row index mapping from the dataframe
+        store, for use after rows have been removed"""
+        self.row_indices = {}
+        for row_number, filepath in enumerate(self.store.get_column('filepath')):
+            if filepath:
+                # Blanked out filepaths of repeated shots are not indexed:
+                self.row_indices[filepath] = row_number
 
     def on_remove_selection(self):
         self.remove_selection()
 
     def remove_selection(self, confirm=True):
         selection_model = self._view.selectionModel()
-        selected_indexes = selection_model.selectedRows()
-        selected_name_items = [self._model.itemFromIndex(index) for index in selected_indexes]
-        if not selected_name_items:
+        selected_rows = sorted(set(index.row() for index in selection_model.selectedRows()))
+        if not selected_rows:
             return
-        if confirm and not question_dialog("Remove %d shots?" % len(selected_name_items)):
+        if confirm and not question_dialog("Remove %d shots?" % len(selected_rows)):
             return
-        # Remove from DataFrame first:
-        self.dataframe = self.dataframe.drop(index.row() for index in selected_indexes)
-        self.dataframe.index = pandas.Index(range(len(self.dataframe)))
-        # Delete one at a time from Qt model:
-        for name_item in selected_name_items:
-            row = name_item.row()
-            self._model.removeRow(row)
+        # Remove from the dataframe store first:
+        self.store.remove_rows(selected_rows)
+        # Then from the Qt model, in reverse order so that removals do not
+        # change the position of rows yet to be removed:
+        for row in reversed(selected_rows):
+            self._model.beginRemoveRows(QtCore.QModelIndex(), row, row)
+            del self.status_percents[row]
+            self._model.endRemoveRows()
+        self._model.clear_cache()
+        self.update_row_indices()
         self.renumber_rows()
 
     def mark_selection_not_done(self):
         selected_indexes = self._view.selectedIndexes()
         selected_rows = set(index.row() for index in selected_indexes)
         for row in selected_rows:
-            status_item = self._model.item(row, self.COL_STATUS)
-            status_item.setData(0, self.ROLE_STATUS_PERCENT)
+            self.status_percents[row] = 0
+            self._model.update_cells(row, [self.COL_STATUS])
 
     def on_view_context_menu_requested(self, point):
         menu = QtGui.QMenu(self._view)
@@ -1205,8 +1671,7 @@ class DataFrameModel(QtCore.QObject):
         menu.exec_(QtGui.QCursor.pos())
 
     def on_double_click(self, index):
-        filepath_item = self._model.item(index.row(), self.COL_FILEPATH)
-        shot_filepath = filepath_item.text()
+        shot_filepath = self.store.get_value(index.row(), 'filepath')
 
         # get path to text editor
         viewer_path = self.exp_config.get('programs', 'hdf5_viewer')
@@ -1235,9 +1700,9 @@ class DataFrameModel(QtCore.QObject):
         """Pads the keys and values of our lists of column names so that
         they still match those in the dataframe after the number of
         levels in its multiindex has increased"""
-        extra_levels = self.dataframe.columns.nlevels - self.nlevels
+        extra_levels = self.store.nlevels - self.nlevels
         if extra_levels > 0:
-            self.nlevels = self.dataframe.columns.nlevels
+            self.nlevels = self.store.nlevels
             column_indices = {}
             column_names = {}
             for column_name in self.column_indices:
@@ -1251,35 +1716,26 @@ class DataFrameModel(QtCore.QObject):
                 column_names[column_index] = new_column_name
             self.column_indices = column_indices
             self.column_names = column_names
+            # Cached text is keyed by column name:
+            self._model.clear_cache()
 
-    @inmain_decorator()
-    def update_row(self, filepath, dataframe_already_updated=False, status_percent=None, new_row_data=None):
-        """"Updates a row in the dataframe and Qt model
-        to the data in the HDF5 file for that shot. Also sets the percent done, if specified"""
-        # Update the row in the dataframe first:
-        df_row_index = np.where(self.dataframe['filepath'].values == filepath)
-        try:
-            df_row_index = df_row_index[0][0]
-        except IndexError:
-            # Row has been deleted, nothing to do here:
-            return
-        if not dataframe_already_updated:
-            if new_row_data is None:
-                # This can be passed in from the caller as a performace optimisation.
-                # Opening the file can be slow, better not to do it in the GUI thread.
-                new_row_data = get_dataframe_from_shot(filepath)
-            self.dataframe = replace_with_padding(self.dataframe, new_row_data, df_row_index)
-            self.update_column_levels()
-
+    def update_columns(self):
+        """Add columns to the Qt model for any new columns in the dataframe,
+        and remove any no longer present. Returns the sets of names of added
+        and removed columns."""
         # Check and create necessary new columns in the Qt model:
-        new_column_names = set(self.dataframe.columns) - set(self.column_names.values())
-        new_columns_start = self._model.columnCount()
-        self._model.insertColumns(new_columns_start, len(new_column_names))
+        new_column_names = set(self.store.column_names) - set(self.column_names.values())
+        new_columns_start = len(self.column_names)
+        if new_column_names:
+            self._model.beginInsertColumns(QtCore.QModelIndex(), new_columns_start,
+                                           new_columns_start + len(new_column_names) - 1)
+            for i, column_name in enumerate(sorted(new_column_names)):
+                column_number = new_columns_start + i
+                self.column_names[column_number] = column_name
+                self.column_indices[column_name] = column_number
+            self._model.endInsertColumns()
         for i, column_name in enumerate(sorted(new_column_names)):
-            # Set the header label of the new column:
             column_number = new_columns_start + i
-            self.column_names[column_number] = column_name
-            self.column_indices[column_name] = column_number
             if column_name in self.deleted_columns_visible:
                 # Restore the former visibility of this column if we've
                 # seen one with its name before:
@@ -1289,167 +1745,159 @@ class DataFrameModel(QtCore.QObject):
             else:
                 # new columns are visible by default:
                 self.columns_visible[column_number] = True
-            column_name_as_string = '\n'.join(column_name).strip()
-            header_item = QtGui.QStandardItem(column_name_as_string)
-            header_item.setToolTip(column_name_as_string)
-            self._model.setHorizontalHeaderItem(column_number, header_item)
-        if new_column_names:
-            # Update the visibility state of new columns, in case some new columns are hidden:
-            self.set_columns_visible
+            # Resize new columns to fit contents:
+            self._view.resizeColumnToContents(column_number)
 
         # Check and remove any no-longer-needed columns in the Qt model:
-        defunct_column_names = (set(self.column_names.values()) - set(self.dataframe.columns)
+        defunct_column_names = (set(self.column_names.values()) - set(self.store.column_names)
                                 - {self.column_names[self.COL_STATUS], self.column_names[self.COL_FILEPATH]})
         defunct_column_indices = [self.column_indices[column_name] for column_name in defunct_column_names]
         for column_number in sorted(defunct_column_indices, reverse=True):
             # Remove columns from the Qt model. In reverse order so that
             # removals do not change the position of columns yet to be
             # removed.
-            self._model.removeColumn(column_number)
+            self._model.beginRemoveColumns(QtCore.QModelIndex(), column_number, column_number)
             # Save whether or not the column was visible when it was
             # removed (so that if it is re-added the visibility will be retained):
             self.deleted_columns_visible[self.column_names[column_number]] = self.columns_visible[column_number]
-            del self.column_names[column_number]
-            del self.columns_visible[column_number]
+            # Move the following columns down one:
+            for later_column_number in range(column_number + 1, len(self.column_names)):
+                self.column_names[later_column_number - 1] = self.column_names[later_column_number]
+                self.columns_visible[later_column_number - 1] = self.columns_visible[later_column_number]
+            del self.column_names[len(self.column_names) - 1]
+            del self.columns_visible[len(self.columns_visible) - 1]
+            self._model.endRemoveColumns()
 
         if defunct_column_indices:
-            # Renumber the keys of self.columns_visible and self.column_names to reflect deletions:
-            self.column_names = {newindex: name for newindex, (oldindex, name) in enumerate(sorted(self.column_names.items()))}
-            self.columns_visible = {newindex: visible for newindex, (oldindex, visible) in enumerate(sorted(self.columns_visible.items()))}
             # Update the inverse mapping of self.column_names:
             self.column_indices = {name: index for index, name in self.column_names.items()}
+            self._model.clear_cache()
 
-        # Update the data in the Qt model:
-        model_row_number = self.get_model_row_by_filepath(filepath)
-        dataframe_row = self.dataframe.iloc[df_row_index].to_dict() # Possible that conversion to dict was not working.
-        
-        for column_number, column_name in self.column_names.items():
-            if not isinstance(column_name, tuple):
-                # One of our special columns, does not correspond to a column in the dataframe:
-                continue
-#            if updated_row_data is not None and column_name not in updated_row_data:
-#                continue
-            
-            item = self._model.item(model_row_number, column_number)
-            if item is None:
-                # This is the first time we've written a value to this part of the model:
-                item = QtGui.QStandardItem('NaN')
-                item.setData(QtCore.Qt.AlignCenter, QtCore.Qt.TextAlignmentRole)
-                self._model.setItem(model_row_number, column_number, item)
-                
-            value = dataframe_row[column_name]
-            if isinstance(value, float):
-                value_str = scientific_notation(value)
-            else:
-                value_str = str(value)
-            lines = value_str.splitlines()
-            if len(lines) > 1:
-                short_value_str = lines[0] + ' ...'
-            else:
-                short_value_str = value_str
-            item.setText(short_value_str)
-            item.setToolTip(repr(value))
+        return new_column_names, defunct_column_names
 
-        for i, column_name in enumerate(sorted(new_column_names)):
-            # Resize any new columns to fit contents:
-            column_number = new_columns_start + i
-            self._view.resizeColumnToContents(column_number)
+    @inmain_decorator()
+    def update_row(self, filepath, dataframe_already_updated=False, status_percent=None, new_row_data=None):
+        """"Updates a row in the dataframe and Qt model
+        to the data in the HDF5 file for that shot. Also sets the percent done, if specified"""
+        # Update the row in the dataframe first:
+        try:
+            df_row_index = self.row_indices[filepath]
+        except KeyError:
+            # Row has been deleted, nothing to do here:
+            return
+        if not dataframe_already_updated:
+            if new_row_data is None:
+                # This can be passed in from the caller as a performace optimisation.
+                # Opening the file can be slow, better not to do it in the GUI thread.
+                new_row_data = get_flat_dict_from_shot(filepath)
+            changed_column_names = self.store.update_row(df_row_index, new_row_data)
+            self.update_column_levels()
+        else:
+            # All columns of the row are to be updated in the Qt model:
+            changed_column_names = None
+
+        new_column_names, defunct_column_names = self.update_columns()
 
+        # Tell the Qt model which cells have changed:
+        if changed_column_names is None:
+            changed_column_numbers = list(self.column_names)
+        else:
+            changed_column_numbers = [self.column_indices[column_name] for column_name in changed_column_names]
         if status_percent is not None:
-            status_item = self._model.item(model_row_number, self.COL_STATUS)
-            status_item.setData(status_percent, self.ROLE_STATUS_PERCENT)
+            self.status_percents[df_row_index] = status_percent
+            changed_column_numbers.append(self.COL_STATUS)
+        self._model.update_cells(df_row_index, changed_column_numbers)
 
         if new_column_names or defunct_column_names:
             self.columns_changed.emit()
 
-    def new_row(self, filepath):
-        status_item = QtGui.QStandardItem()
-        status_item.setData(0, self.ROLE_STATUS_PERCENT)
-        status_item.setIcon(QtGui.QIcon(':qtutils/fugue/tick'))
-        name_item = QtGui.QStandardItem(filepath)
-        return [status_item, name_item]
-
     def renumber_rows(self):
         """Add/update row indices - the rows are numbered in simple sequential order
         for easy comparison with the dataframe"""
-        n_digits = len(str(self._model.rowCount()))
-        print(self._model.rowCount())
-        for row_number in range(self._model.rowCount()):
-            vertical_header_item = self._model.verticalHeaderItem(row_number)
-            filepath_item = self._model.item(row_number, self.COL_FILEPATH)
-            filepath = filepath_item.text()
-            basename = os.path.splitext(os.path.basename(filepath))[0]
-            row_number_str = str(row_number).rjust(n_digits)
-            vert_header_text = '{}. | {}'.format(row_number_str, basename)
-            vertical_header_item.setText(vert_header_text)
+        # The row numbers are generated on demand by the Qt model, so it
+        # only needs to tell the view to refresh them:
+        self._model.update_vertical_header()
     
     @inmain_decorator()
     def add_files(self, filepaths, new_row_data=None):
+        """Add rows for the given shot files. new_row_data, if given, is a
+        list of flat dictionaries of shot data, one per filepath."""
+        if new_row_data is None:
+            # This can be passed in from the caller as a performace optimisation.
+            # Opening the file can be slow, better not to do it in the GUI thread:
+            new_row_data = [get_flat_dict_from_shot(filepath) for filepath in filepaths]
+        else:
+            assert len(new_row_data) == len(filepaths)
         to_add = []
-        for filepath in filepaths:
+        rows_to_add = []
+        for filepath, row in zip(filepaths, new_row_data):
             # Ignore duplicate shots when not doing repeats.
             (isRep, _, _, _) =   labscript_utils.file_utils.is_rep_name(filepath)
 
-            if not filepath in self.dataframe['filepath'].values:
+            if not filepath in self.row_indices:
                 # we are not a duplicate
                 to_add.append(filepath)
+                rows_to_add.append(row)
             elif isRep:
                 # We are a duplicate, but also a rep
                 to_add.append(filepath)
+                rows_to_add.append(row)
                 
-                # Remove all instances from dataframe:
-                idx = self.dataframe['filepath'].values == filepath
-                self.dataframe['filepath'][idx] = ""
-                
-                # And also from the front panel
-                filepath_colname = ('filepath',) + ('',) * (self.nlevels - 1)
-                existing_items = self._model.findItems(filepath, column=self.column_indices[filepath_colname])
-                
-                for item in existing_items:
-                    item.setText("")
-                    item.setToolTip("")
+                # Remove the existing instance from dataframe, and also
+                # from the front panel:
+                existing_row = self.row_indices.pop(filepath)
+                self.store.set_value(existing_row, 'filepath', "")
+                self._model.update_cells(existing_row, [self.COL_FILEPATH])
                 
             else:
                 # Ignore duplicates:
                 app.output_box.output('Warning: Ignoring duplicate shot %s\n' % filepath, red=True)
-                if new_row_data is not None:
-                    df_row_index = np.where(new_row_data['filepath'].values == filepath)
-                    new_row_data = new_row_data.drop(df_row_index[0])
-                    new_row_data.index = pandas.Index(range(len(new_row_data)))
-
-        for filepath in to_add:
-            # Add the new row to the model:
-            self._model.appendRow(self.new_row(filepath))
-            vert_header_item = QtGui.QStandardItem('...loading...')
-            self._model.setVerticalHeaderItem(self._model.rowCount() - 1, vert_header_item)
-            self._view.resizeRowToContents(self._model.rowCount() - 1)
-        # Add the new rows to the dataframe.
-        if new_row_data is None:
-            # This can be passed in from the caller as a performace optimisation.
-            # Opening the file can be slow, better not to do it in the GUI thread:
-            new_row_data = get_dataframe_from_shots(to_add)
-        else:
-            assert len(new_row_data) == len(to_add)
-        self.dataframe = concat_with_padding(self.dataframe, new_row_data)
-        
+
+        if not to_add:
+            return
+        # Add the new rows to the dataframe store and the Qt model:
+        first_new_row = len(self.status_percents)
+        self._model.beginInsertRows(QtCore.QModelIndex(), first_new_row, first_new_row + len(to_add) - 1)
+        self.store.append_rows(rows_to_add)
+        self.status_percents.extend([0] * len(to_add))
+        self._model.endInsertRows()
+        for i, filepath in enumerate(to_add):
+            self.row_indices[filepath] = first_new_row + i
         self.update_column_levels()
-        for filepath in to_add:
-            self.update_row(filepath, dataframe_already_updated=True)
+        new_column_names, defunct_column_names = self.update_columns()
+        if new_column_names or defunct_column_names:
+            self.columns_changed.emit()
         self.renumber_rows()
 
     @inmain_decorator()
-    def get_first_incomplete(self):
+    def get_first_incomplete(self, exclude=()):
         """Returns the filepath of the first shot in the model that has not
-        been analysed"""
-        for row in range(self._model.rowCount()):
-            status_item = self._model.item(row, self.COL_STATUS)
-            if status_item.data(self.ROLE_STATUS_PERCENT) != 100:
-                filepath_item = self._model.item(row, self.COL_FILEPATH)
-                return filepath_item.text()
+        been analysed, other than those in exclude"""
+        for row, status_percent in enumerate(self.status_percents):
+            if status_percent != 100:
+                filepath = self.store.get_value(row, 'filepath')
+                if filepath not in exclude:
+                    return filepath
+
+
+def read_shot_or_error(filepath):
+    """Returns a tuple of the flat dictionary of data from a shot file and
+    None, or None and the formatted traceback if the file could not be read.
+    For reading shots with a worker pool, in which an exception raised for
+    one shot would end the iteration over the results of the rest."""
+    try:
+        return get_flat_dict_from_shot(filepath), None
+    except Exception:
+        return None, traceback.format_exc()
 
 
 class FileBox(object):
 
+    # The most shots that will be read from disk and added to the model in
+    # one go. Batches are smaller when fewer shots are waiting, so that the
+    # GUI still updates promptly when shots trickle in:
+    MAX_INGEST_BATCH_SIZE = 200
+
     def __init__(self, container, exp_config, to_singleshot, from_singleshot, to_multishot, from_multishot):
 
         self.exp_config = exp_config
@@ -1477,6 +1925,15 @@ class FileBox(object):
         self.analysis_paused = False
         self.multishot_required = False
 
+        # How many shots may be being analysed at once. Each shot is still
+        # analysed by its routines in order, and each routine analyses shots
+        # one at a time and in order (unless it has more than one worker), but
+        # a routine can start on the next shot whilst routines further down
+        # the list are still busy with the previous ones. Set pipeline_depth
+        # = 1 in the [lyse] section of the labconfig to analyse one shot at a
+        # time, other than in routines with more than one worker:
+        self.pipeline_depth = max(1, int(get_config_option(self.exp_config, 'lyse', 'pipeline_depth', 4)))
+
         # An Event to let the analysis thread know to check for shots that
         # need analysing, rather than using a time.sleep:
         self.analysis_pending = threading.Event()
@@ -1489,6 +1946,21 @@ class FileBox(object):
         # or paused:
         self.incoming_queue = Queue.Queue()
 
+        # A pool of workers to read incoming shot files concurrently:
+        self.n_ingest_workers, self.ingest_pool = self.start_ingest_pool()
+
+        # A cache of data read from shot files, so that files do not need to
+        # be read again if they are reloaded unchanged. Set the
+        # metadata_cache setting in the [lyse] section of the labconfig to
+        # an empty string to disable:
+        default_cache_path = os.path.join(config_prefix, 'lyse_metadata_cache.sqlite')
+        cache_path = get_config_option(self.exp_config, 'lyse', 'metadata_cache', default_cache_path)
+        cache_size = int(get_config_option(self.exp_config, 'lyse', 'metadata_cache_size', 100000))
+        if cache_path:
+            self.metadata_cache = ShotMetadataCache(cache_path, cache_size)
+        else:
+            self.metadata_cache = None
+
         # Start the thread to handle incoming files, and store them in
         # a buffer if processing is paused:
         self.incoming = threading.Thread(target=self.incoming_buffer_loop)
@@ -1530,9 +2002,8 @@ class FileBox(object):
 
         # Save the containing folder for use next time we open the dialog box:
         self.last_opened_shots_folder = os.path.dirname(shot_files[0])
-        # Queue the files to be opened:
-        for filepath in shot_files:
-            self.incoming_queue.put(filepath)
+        # Queue the files to be opened, as a single batch:
+        self.incoming_queue.put(shot_files)
 
     def on_analysis_running_toggled(self, pressed):
         if pressed:
@@ -1567,6 +2038,61 @@ class FileBox(object):
             if self.ui.progressBar_add_shots.isHidden():
                 self.ui.progressBar_add_shots.show()
 
+    def start_ingest_pool(self):
+        """Start the pool of threads for reading shot files, as many as the
+        ingest_workers setting in the [lyse] section of the labconfig. These
+        are threads rather than processes, since forked processes would
+        inherit the zprocess locking client's zmq context, which h5_lock uses
+        and which is not safe to use after a fork."""
+        n_workers = int(get_config_option(self.exp_config, 'lyse', 'ingest_workers', 4))
+        # HDF5 errors are silenced per thread, so silence them in the workers too:
+        pool = multiprocessing.pool.ThreadPool(n_workers, h5py._errors.silence_errors)
+        self.logger.info('reading shots with %d threads' % n_workers)
+        return n_workers, pool
+
+    def read_shots(self, filepaths):
+        """Read the data from the given shot files using the ingest pool and
+        the metadata cache. Yields (filepath, row) tuples of each filepath and
+        the flat dictionary of its shot data, in the same order as the
+        filepaths. The row is None for files that could not be read, for which
+        the error is logged and shown in the output box, so that one bad file
+        doesn't stop the rest being added."""
+        keys = []
+        cached_rows = []
+        for filepath in filepaths:
+            key = row = None
+            if self.metadata_cache is not None:
+                try:
+                    # Get the cache key before reading, so that a file
+                    # modified during reading will not have stale data cached:
+                    key = self.metadata_cache.stat(filepath)
+                except OSError:
+                    # Reading the file will fail too, and report the error:
+                    pass
+                else:
+                    row = self.metadata_cache.get(key, filepath)
+            keys.append(key)
+            cached_rows.append(row)
+        uncached_filepaths = [filepath for filepath, cached_row in zip(filepaths, cached_rows) if cached_row is None]
+        results = self.ingest_pool.imap(read_shot_or_error, uncached_filepaths)
+        for filepath, key, row in zip(filepaths, keys, cached_rows):
+            if row is None:
+                row, error = next(results)
+                if error is not None:
+                    self.logger.error('could not read %s:\n%s' % (filepath, error))
+                    app.output_box.output('Error reading shot %s, not adding it:\n%s' % (filepath, error), red=True)
+                elif key is not None:
+                    self.metadata_cache.put(key, row)
+            yield filepath, row
+
+    def read_shot(self, filepath, refresh=False):
+        """Read the data from a single shot file, using the metadata cache.
+        If refresh is True, the file is read regardless of what is cached,
+        and the cache updated."""
+        if self.metadata_cache is None:
+            return get_flat_dict_from_shot(filepath)
+        return self.metadata_cache.get_flat_dict_from_shot(filepath, refresh)
+
     def incoming_buffer_loop(self):
         """We use a queue as a buffer for incoming shots. We don't want to hang and not
         respond to a client submitting shots, so we just let shots pile up here until we can get to them.
@@ -1581,48 +2107,73 @@ class FileBox(object):
         # imported. So we'll silence them in this thread too:
         h5py._errors.silence_errors()
         n_shots_added = 0
+        # Filepaths from a list too long to read in one batch, to be read
+        # before anything else in the queue:
+        pending = []
         while True:
             try:
+                # Items in the queue are either a single filepath, or a list
+                # of filepaths submitted together, which is read as one
+                # batch, or several if it is longer than the maximum batch
+                # size:
                 filepaths = []
-                filepath = self.incoming_queue.get()
-                filepaths.append(filepath)
-                if self.incoming_queue.qsize() == 0:
-                    # Wait momentarily in case more arrive so we can batch process them:
-                    time.sleep(0.1)
-                while True:
-                    try:
-                        filepath = self.incoming_queue.get(False)
-                    except Queue.Empty:
-                        break
-                    else:
-                        filepaths.append(filepath)
-                        if len(filepaths) >= 5:
+                if pending:
+                    item, pending = pending, []
+                else:
+                    item = self.incoming_queue.get()
+                if isinstance(item, list):
+                    filepaths.extend(item)
+                else:
+                    filepaths.append(item)
+                    # Take as many shots as are waiting, up to the maximum
+                    # batch size, but at least enough to keep all the workers
+                    # busy if that many are waiting:
+                    batch_size = max(self.n_ingest_workers, self.incoming_queue.qsize() + 1)
+                    batch_size = min(batch_size, self.MAX_INGEST_BATCH_SIZE)
+                    while len(filepaths) < batch_size:
+                        try:
+                            item = self.incoming_queue.get(False)
+                        except Queue.Empty:
+                            break
+                        if isinstance(item, list):
+                            filepaths.extend(item)
                             break
+                        filepaths.append(item)
+                pending = filepaths[self.MAX_INGEST_BATCH_SIZE:]
+                filepaths = filepaths[:self.MAX_INGEST_BATCH_SIZE]
                 logger.info('adding:\n%s' % '\n'.join(filepaths))
                 if n_shots_added == 0:
-                    total_shots = self.incoming_queue.qsize() + len(filepaths)
+                    total_shots = self.incoming_queue.qsize() + len(pending) + len(filepaths)
                     self.set_add_shots_progress(1, total_shots)
 
                 # Remove duplicates from the list (preserving order) in case the
                 # client sent the same filepath multiple times:
-                filepaths = sorted(set(filepaths), key=filepaths.index) # Inefficient but readable
-                # We open the HDF5 files here outside the GUI thread so as not to hang the GUI:
-                dataframes = []
-                for i, filepath in enumerate(filepaths):
-                    dataframe = get_dataframe_from_shot(filepath)
-                    dataframes.append(dataframe)
+                filepaths = list(collections.OrderedDict.fromkeys(filepaths))
+                # We open the HDF5 files here outside the GUI thread so as not to hang the GUI.
+                # They are read concurrently by the pool, and come back in order.
+                # Files that can't be read are skipped:
+                read_filepaths = []
+                rows = []
+                for i, (filepath, row) in enumerate(self.read_shots(filepaths)):
+                    if row is not None:
+                        read_filepaths.append(filepath)
+                        rows.append(row)
                     n_shots_added += 1
-                    shots_remaining = self.incoming_queue.qsize()
+                    shots_remaining = self.incoming_queue.qsize() + len(pending)
                     total_shots = n_shots_added + shots_remaining + len(filepaths) - (i + 1)
                     if i != len(filepaths) - 1:
-                        # Leave the last update until after dataframe concatenation.
+                        # Leave the last update until after the rows are added.
                         # Looks more responsive that way:
                         self.set_add_shots_progress(n_shots_added, total_shots)
-                new_row_data = concat_with_padding(*dataframes)
                 self.set_add_shots_progress(n_shots_added, total_shots)
-                self.shots_model.add_files(filepaths, new_row_data)
+                if rows:
+                    self.shots_model.add_files(read_filepaths, rows)
                 if shots_remaining == 0:
                     n_shots_added = 0 # reset our counter for the next batch
+                    if self.metadata_cache is not None:
+                        hits, misses = self.metadata_cache.reset_stats()
+                        if hits:
+                            app.output_box.output('Shot metadata cache: %d hits, %d misses\n' % (hits, misses))
                 # Let the analysis loop know to look for new shots:
                 self.analysis_pending.set()
             except Exception:
@@ -1637,58 +2188,78 @@ class FileBox(object):
         # and automatically silenced in the main thread when h5py is
         # imported. So we'll silence them in this thread too:
         h5py._errors.silence_errors()
+        # Shots sent for singleshot analysis that are not yet finished, in
+        # the order they were sent:
+        in_flight = []
         while True:
             self.analysis_pending.wait()
             self.analysis_pending.clear()
             at_least_one_shot_analysed = False
             while True:
-                if not self.analysis_paused:
-                    # Find the first shot that has not finished being analysed:
-                    filepath = self.shots_model.get_first_incomplete()
-                    if filepath is not None:
+                if not self.analysis_paused and not self.multishot_required:
+                    # Keep up to pipeline_depth shots in the pipeline at once,
+                    # in order, starting with the first that has not finished
+                    # being analysed:
+                    while len(in_flight) < self.get_pipeline_depth():
+                        filepath = self.shots_model.get_first_incomplete(exclude=in_flight)
+                        if filepath is None:
+                            break
                         logger.info('analysing: %s'%filepath)
-                        self.do_singleshot_analysis(filepath)
+                        self.to_singleshot.put(filepath)
+                        in_flight.append(filepath)
                         at_least_one_shot_analysed = True
-                    if filepath is None and at_least_one_shot_analysed:
-                        self.multishot_required = True
-                    if filepath is None:
-                        break
-                    if self.multishot_required:
-                        logger.info('doing multishot analysis')
-                        self.do_multishot_analysis()
-                else:
+                if in_flight:
+                    self.process_singleshot_message(in_flight)
+                elif self.analysis_paused:
                     logger.info('analysis is paused')
                     break
+                elif self.multishot_required:
+                    logger.info('doing multishot analysis')
+                    self.do_multishot_analysis()
+                else:
+                    if at_least_one_shot_analysed:
+                        self.multishot_required = True
+                    break
             if self.multishot_required:
                 logger.info('doing multishot analysis')
                 self.do_multishot_analysis()
 
 
+    def get_pipeline_depth(self):
+        """How many shots to send for singleshot analysis at once. This is at
+        least as many as the most workers any singleshot routine has, so that
+        they can all be kept busy."""
+        routines = app.singleshot_routinebox.routines
+        return max([self.pipeline_depth] + [routine.n_workers for routine in routines])
+
     @inmain_decorator()
     def pause_analysis(self):
         # This automatically triggers the slot that sets self.analysis_paused
         self.ui.pushButton_analysis_running.setChecked(True)
 
-    def do_singleshot_analysis(self, filepath):
-        self.to_singleshot.put(filepath)
-        while True:
-            signal, status_percent = self.from_singleshot.get()
-            if signal in ['error', 'progress']:
-                # Do the file reading here outside the GUI thread so as not to hang the GUI:
-                new_row_data = get_dataframe_from_shot(filepath)
-                self.shots_model.update_row(filepath, status_percent=status_percent, new_row_data=new_row_data)
-            if signal == 'done':
-                # No need to update the dataframa again, that should have been done with the last 'progress' signal:
-                self.shots_model.update_row(filepath, status_percent=status_percent, dataframe_already_updated=True)
-                return
-            if signal == 'error':
-                self.pause_analysis()
-                return
+    def process_singleshot_message(self, in_flight):
+        """Wait for a message from the singleshot routine box about one of
+        the shots in the pipeline, and update the shot's row accordingly.
+        Shots are removed from in_flight once their analysis is over."""
+        signal, filepath, status_percent = self.from_singleshot.get()
+        if signal in ['error', 'progress']:
+            # Do the file reading here outside the GUI thread so as not to hang the GUI.
+            # The routine may have written to the file within the resolution of its
+            # modification time, so don't trust the cache:
+            new_row_data = self.read_shot(filepath, refresh=True)
+            self.shots_model.update_row(filepath, status_percent=status_percent, new_row_data=new_row_data)
+        if signal == 'done':
+            # No need to update the dataframa again, that should have been done with the last 'progress' signal:
+            self.shots_model.update_row(filepath, status_percent=status_percent, dataframe_already_updated=True)
+        if signal == 'error':
+            self.pause_analysis()
+        if signal in ['done', 'error', 'incomplete']:
+            in_flight.remove(filepath)
 
     def do_multishot_analysis(self):
         self.to_multishot.put(None)
         while True:
-            signal, _ = self.from_multishot.get()
+            signal, _, _ = self.from_multishot.get()
             if signal == 'done':
                 self.multishot_required = False
                 return
@@ -1787,7 +2358,8 @@ if __name__ == "__main__":
     app = Lyse()
 
     # Start the web server:
-    server = WebServer(app.port)
+    server_threads = int(get_config_option(app.exp_config, 'lyse', 'server_threads', 4))
+    server = WebServer(app.port, n_threads=max(1, server_threads))
 
     # Let the interpreter run every 500ms so it sees Ctrl-C interrupts:
     timer = QtCore.QTimer()
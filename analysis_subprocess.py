@@ -40,16 +40,28 @@ lyse.spinning_top = True
 import lyse.figure_manager
 lyse.figure_manager.install()
 
+# User code runs outside the main thread, but matplotlib figures are Qt
+# objects when using the Qt backend, so must be created and closed in the
+# main thread. Whilst user code runs, the canvases of existing plot windows
+# are suspended (see Canvas), so that the main thread doesn't draw or
+# modify figures at the same time, since matplotlib is not thread-safe:
+_figuremanager = lyse.figure_manager.figuremanager
+_figure, _close = _figuremanager._figure, _figuremanager._close
+_figuremanager._figure = lambda *args, **kwargs: inmain(_figure, *args, **kwargs)
+_figuremanager._close = lambda *args, **kwargs: inmain(_close, *args, **kwargs)
+
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
 import pylab
 import zprocess.locking, labscript_utils.h5_lock, h5py
 
 import zprocess
-from qtutils import inmain, inmain_later, inmain_decorator, UiLoader, inthread, DisconnectContextManager
+from qtutils import inmain, inmain_later, UiLoader, inthread, DisconnectContextManager
+from qtutils.invoke_in_main import get_inmain_result
 import qtutils.icons
 
 from labscript_utils.modulewatcher import ModuleWatcher
+from lyse.code_cache import CodeCache
 
 class _DeprecationDict(dict):
     """Dictionary that spouts deprecation warnings when you try to access some
@@ -120,7 +132,26 @@ class PlotWindow(QtGui.QWidget):
         event.ignore()
         
 
+class Canvas(FigureCanvas):
+    """A figure canvas that can be suspended whilst an analysis routine
+    modifies its figure in another thread. Whilst suspended, it neither draws
+    the figure nor repaints itself."""
+    def __init__(self, figure):
+        FigureCanvas.__init__(self, figure)
+        self.suspended = False
+
+    def draw(self):
+        if not self.suspended:
+            FigureCanvas.draw(self)
+
+    def paintEvent(self, event):
+        if not self.suspended:
+            FigureCanvas.paintEvent(self, event)
+
+
 class Plot(object):
+    """A window showing a figure. All methods must be called from the main
+    thread."""
     def __init__(self, figure, identifier, filepath):
         loader = UiLoader()
         self.ui = loader.load('plot_window.ui', PlotWindow())
@@ -133,7 +164,7 @@ class Plot(object):
 
         # figure.tight_layout()
         self.figure = figure
-        self.canvas = FigureCanvas(figure)
+        self.canvas = Canvas(figure)
         self.navigation_toolbar = NavigationToolbar(self.canvas, self.ui)
 
         self.lock_action = self.navigation_toolbar.addAction(
@@ -170,7 +201,16 @@ class Plot(object):
     def on_copy_to_clipboard_triggered(self):
         lyse.figure_to_clipboard(self.figure)
 
-    @inmain_decorator()
+    def set_suspended(self, suspended):
+        """Suspend or resume drawing of the figure, and disable or enable the
+        canvas and toolbar so that the user can't pan, zoom or otherwise
+        modify it whilst suspended"""
+        self.canvas.suspended = suspended
+        self.canvas.setEnabled(not suspended)
+        self.navigation_toolbar.setEnabled(not suspended)
+        if not suspended:
+            self.canvas.update()
+
     def save_axis_limits(self):
         axis_limits = {}
         for i, ax in enumerate(self.figure.axes):
@@ -179,11 +219,9 @@ class Plot(object):
 
         self.axis_limits = axis_limits
 
-    @inmain_decorator()
     def clear(self):
         self.figure.clear()
 
-    @inmain_decorator()
     def restore_axis_limits(self):
         for i, ax in enumerate(self.figure.axes):
             try:
@@ -193,18 +231,15 @@ class Plot(object):
             except KeyError:
                 continue
 
-    @inmain_decorator()
     def set_window_title(self, identifier, filepath):
         self.ui.setWindowTitle(str(identifier) + ' - ' + os.path.basename(filepath))
 
-    @inmain_decorator()
     def update_window_size(self):
         l, w = self.figure.get_size_inches()
         dpi = self.figure.get_dpi()
         self.canvas.resize(int(l*dpi),int(w*dpi))
         self.ui.adjustSize()
 
-    @inmain_decorator()
     def draw(self):
         self.canvas.draw()
 
@@ -217,10 +252,13 @@ class Plot(object):
 
 
 class AnalysisWorker(object):
-    def __init__(self, filepath, to_parent, from_parent):
+    def __init__(self, filepath, to_parent, from_parent, plots=True):
         self.to_parent = to_parent
         self.from_parent = from_parent
         self.filepath = filepath
+        # Whether to show plot windows. When a routine has several workers,
+        # only one of them shows plots:
+        self.show_plots = plots
         
         # Add user script directory to the pythonpath:
         sys.path.insert(0, os.path.dirname(self.filepath))
@@ -228,9 +266,20 @@ class AnalysisWorker(object):
         # Plot objects, keyed by matplotlib Figure object:
         self.plots = {}
 
+        # The result queue of the last shot's updating of plot windows in the
+        # main thread, which may not have finished yet:
+        self.pending_plot_update = None
+
         # An object with a method to unload user modules if any have
         # changed on disk:
         self.modulewatcher = ModuleWatcher()
+
+        # The compiled routine, so that it is only read and compiled again
+        # when it changes:
+        self.code_cache = CodeCache()
+
+        # The initial namespace the routine runs in, copied for each shot:
+        self.sandbox_template = {'__name__': '__main__', '__file__': self.filepath}
         
         # Start the thread that listens for instructions from the
         # parent process:
@@ -259,8 +308,13 @@ class AnalysisWorker(object):
                 else:
                     self.to_parent.put(['error','invalid task %s'%str(task)])
         
-    @inmain_decorator()
     def do_analysis(self, path):
+        """Run the user's analysis on a shot. This runs in the mainloop
+        thread rather than the main thread, so that the plot windows can still
+        be moved and resized whilst the analysis runs, though their figures
+        are not drawn or interactive until it is done. Plots are updated in the main
+        thread afterward, without waiting for them to be drawn, so that
+        drawing overlaps with the next shot being sent and prepared for."""
         now = time.strftime('[%x %X]')
         if path is not None:
             print('%s %s %s ' %(now, os.path.basename(self.filepath), os.path.basename(path)))
@@ -270,9 +324,7 @@ class AnalysisWorker(object):
         self.pre_analysis_plot_actions()
 
         # The namespace the routine will run in:
-        sandbox = _DeprecationDict(path=path,
-                                   __name__='__main__',
-                                   __file__= self.filepath)
+        sandbox = _DeprecationDict(self.sandbox_template, path=path)
         # path global variable is deprecated:
         deprecation_message = ("use of 'path' global variable is deprecated and will be removed " +
                                "in a future version of lyse.  Please use lyse.path, which defaults " +
@@ -285,7 +337,8 @@ class AnalysisWorker(object):
         try:
             with self.modulewatcher.lock:
                 # Actually run the user's analysis!
-                execfile(self.filepath, sandbox, sandbox)
+                code = self.code_cache.get(self.filepath)
+                exec(code, sandbox, sandbox)
         except:
             traceback_lines = traceback.format_exception(*sys.exc_info())
             del traceback_lines[1]
@@ -299,14 +352,42 @@ class AnalysisWorker(object):
             self.post_analysis_plot_actions()
         
     def pre_analysis_plot_actions(self):
+        # The figures can't be modified until they have finished being drawn
+        # for the last shot:
+        if self.pending_plot_update is not None:
+            queue, self.pending_plot_update = self.pending_plot_update, None
+            try:
+                get_inmain_result(queue)
+            except Exception:
+                # Drawing errors don't belong to the shot about to be analysed:
+                traceback.print_exc()
+        if not self.show_plots:
+            # Clear figures left over from the last shot, so that they are
+            # reused rather than accumulating:
+            for fig in lyse.figure_manager.figuremanager.figs.values():
+                fig.clear()
+            return
+        inmain(self.clear_plots)
+
+    def clear_plots(self):
         for plot in self.plots.values():
+            # Until update_plots() is called after the analysis:
+            plot.set_suspended(True)
             plot.save_axis_limits()
             plot.clear()
 
     def post_analysis_plot_actions(self):
         # reset the current figure to figure 1:
         lyse.figure_manager.figuremanager.set_first_figure_current()
-        # Introspect the figures that were produced:
+        if not self.show_plots:
+            return
+        self.pending_plot_update = inmain_later(self.update_plots)
+
+    def update_plots(self):
+        """Make or update the plot windows for the figures that were
+        produced. Called in the main thread."""
+        for plot in self.plots.values():
+            plot.set_suspended(False)
         for identifier, fig in lyse.figure_manager.figuremanager.figs.items():
             if not fig.axes:
                 continue
@@ -325,7 +406,6 @@ class AnalysisWorker(object):
                     plot.restore_axis_limits()
                 plot.draw()
 
-
     def new_figure(self, fig, identifier):
         self.plots[fig] = Plot(fig, identifier, self.filepath)
 
@@ -334,12 +414,12 @@ class AnalysisWorker(object):
         
         
 if __name__ == '__main__':
-    filepath = from_parent.get()
+    filepath, plots = from_parent.get()
     
     # Set a meaningful client id for zprocess.locking:
     zprocess.locking.set_client_process_name('lyse-'+os.path.basename(filepath))
     
     qapplication = QtGui.QApplication(sys.argv)
-    worker = AnalysisWorker(filepath, to_parent, from_parent)
+    worker = AnalysisWorker(filepath, to_parent, from_parent, plots)
     qapplication.exec_()
         
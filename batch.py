@@ -0,0 +1,200 @@
+#####################################################################
+#                                                                   #
+# /batch.py                                                         #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+"""Run analysis routines on shot files without the lyse GUI. Run as:
+
+    python -m lyse batch [options] <shot file or glob> [...]
+
+for example:
+
+    python -m lyse batch -s fit_image.py -s fit_trace.py -m plot_fits.py \\
+        '/data/2017/03/*/*.h5'
+
+Singleshot routines are run on each shot in the order given, with shots
+farmed out across a pool of worker processes. Multishot routines are then
+run once, in the order given, with lyse.data() returning a dataframe of all
+the shots. Routines see the same lyse.path, Run and data() as they do when
+run from within lyse. Figures are drawn with a non-interactive backend and
+never shown."""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import glob
+import time
+import argparse
+import traceback
+import multiprocessing
+
+import matplotlib
+matplotlib.use('Agg')
+
+import lyse
+import lyse.figure_manager
+from lyse.code_cache import CodeCache
+
+# Compiled routines, so that each is only compiled once per process:
+code_cache = CodeCache()
+
+
+def get_shot_files(patterns):
+    """Expand any glob patterns and return the shot files in sorted order,
+    without duplicates"""
+    filepaths = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches and os.path.exists(pattern):
+            # A filename with glob special characters in it:
+            matches = [pattern]
+        filepaths.update(os.path.abspath(match) for match in matches)
+    return sorted(filepaths)
+
+
+def run_routine(routine, filepath):
+    """Run an analysis routine as lyse would, with lyse.path set to the
+    given filepath. Returns whether the routine ran without raising an
+    exception, printing the traceback if not."""
+    sandbox = {'path': filepath, '__name__': '__main__', '__file__': routine}
+    lyse.path = filepath
+    try:
+        exec(code_cache.get(routine), sandbox, sandbox)
+    except Exception:
+        traceback_lines = traceback.format_exception(*sys.exc_info())
+        del traceback_lines[1]
+        message = ''.join(traceback_lines)
+        if filepath is not None:
+            message = '%s on %s:\n%s' % (os.path.basename(routine), os.path.basename(filepath), message)
+        else:
+            message = '%s:\n%s' % (os.path.basename(routine), message)
+        sys.stderr.write(message)
+        return False
+    finally:
+        # Reuse the figures for the next shot rather than accumulating them:
+        for fig in lyse.figure_manager.figuremanager.figs.values():
+            fig.clear()
+    return True
+
+
+def _init_worker():
+    # HDF5 prints lots of errors by default, for things that aren't
+    # actually errors. These are silenced on a per thread basis:
+    import h5py
+    h5py._errors.silence_errors()
+
+
+def analyse_shot(args):
+    """Run the singleshot routines on a shot, stopping at the first that
+    fails. Returns the shot's index, a list of (routine, success, duration)
+    for each routine run, and the shot's data as a flat dictionary if
+    read_data is True. To be run in a worker process."""
+    index, filepath, routines, read_data = args
+    results = []
+    for routine in routines:
+        start_time = time.time()
+        success = run_routine(routine, filepath)
+        results.append((routine, success, time.time() - start_time))
+        if not success:
+            break
+    row = None
+    if read_data:
+        from lyse.dataframe_utilities import get_flat_dict_from_shot
+        try:
+            row = get_flat_dict_from_shot(filepath)
+        except Exception:
+            sys.stderr.write('Could not read %s:\n%s' % (filepath, traceback.format_exc()))
+    return index, results, row
+
+
+def print_summary(n_shots, n_failed, routine_times, elapsed):
+    print('')
+    print('%d shots analysed in %.1f s (%.2f shots per second), %d failed' %
+          (n_shots, elapsed, n_shots / elapsed if elapsed else 0, n_failed))
+    for routine, times in routine_times:
+        if times:
+            print('  %s: %d runs, %.3f s mean, %.1f s total' %
+                  (os.path.basename(routine), len(times), sum(times) / len(times), sum(times)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m lyse batch',
+                                     description='Run lyse analysis routines on shot files without the GUI.')
+    parser.add_argument('shots', nargs='+', metavar='SHOT',
+                        help='shot files, or glob patterns matching shot files')
+    parser.add_argument('-s', '--singleshot', action='append', default=[], metavar='ROUTINE',
+                        help='a singleshot routine to run on every shot. May be given more than once')
+    parser.add_argument('-m', '--multishot', action='append', default=[], metavar='ROUTINE',
+                        help='a multishot routine to run after the singleshot routines. May be given more than once')
+    parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes for singleshot analysis (default: number of CPUs)')
+    args = parser.parse_args(argv)
+
+    filepaths = get_shot_files(args.shots)
+    if not filepaths:
+        parser.error('no shot files found')
+    singleshot_routines = [os.path.abspath(routine) for routine in args.singleshot]
+    multishot_routines = [os.path.abspath(routine) for routine in args.multishot]
+    for routine in singleshot_routines + multishot_routines:
+        if not os.path.isfile(routine):
+            parser.error('no such routine: %s' % routine)
+        # Routines can import modules from their own folder, as in lyse:
+        routine_dir = os.path.dirname(routine)
+        if routine_dir not in sys.path:
+            sys.path.insert(0, routine_dir)
+
+    # Figures are drawn but never shown. This must be done before pyplot is
+    # imported, and before the worker processes are started so that they
+    # inherit it:
+    lyse.spinning_top = True
+    lyse.figure_manager.install()
+
+    # Only need to read the shots if there is a multishot routine to use
+    # the dataframe:
+    read_data = bool(multishot_routines)
+    rows = [None] * len(filepaths)
+    routine_times = [(routine, []) for routine in singleshot_routines]
+    n_failed = 0
+    multishot_failed = False
+    start_time = time.time()
+    pool = multiprocessing.Pool(max(1, args.processes), _init_worker)
+    try:
+        tasks = [(i, filepath, singleshot_routines, read_data) for i, filepath in enumerate(filepaths)]
+        for n_done, (index, results, row) in enumerate(pool.imap_unordered(analyse_shot, tasks), 1):
+            rows[index] = row
+            for routine, success, duration in results:
+                routine_times[singleshot_routines.index(routine)][1].append(duration)
+            success = all(success for _, success, _ in results)
+            if not success:
+                n_failed += 1
+            print('[%d/%d] %s%s' % (n_done, len(filepaths), os.path.basename(filepaths[index]),
+                                    '' if success else ': error'))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if multishot_routines:
+        from lyse.dataframe_store import DataFrameStore
+        store = DataFrameStore()
+        store.append_rows([row for row in rows if row is not None])
+        lyse._local_store = store
+        for routine in multishot_routines:
+            print('running %s' % os.path.basename(routine))
+            multishot_start_time = time.time()
+            success = run_routine(routine, None)
+            routine_times.append((routine, [time.time() - multishot_start_time]))
+            if not success:
+                multishot_failed = True
+                break
+
+    print_summary(len(filepaths), n_failed, routine_times, time.time() - start_time)
+    return 1 if n_failed or multishot_failed else 0
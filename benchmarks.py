@@ -0,0 +1,189 @@
+#####################################################################
+#                                                                   #
+# /benchmarks.py                                                    #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+"""Benchmarks for the performance critical parts of lyse. Run as:
+
+    python -m lyse.benchmarks <benchmark name> [args]
+
+Run with no arguments for a list of available benchmarks."""
+
+from __future__ import division, print_function
+
+import sys
+import time
+import cPickle as pickle
+
+import labscript_utils.h5_lock, h5py
+
+
+class _CountingFile(h5py.File):
+    """A h5py.File that counts how many times files are opened"""
+    n_opens = 0
+
+    def __init__(self, *args, **kwargs):
+        _CountingFile.n_opens += 1
+        h5py.File.__init__(self, *args, **kwargs)
+
+
+def count_opens(function, *args, **kwargs):
+    """Call function(*args, **kwargs) and return the number of times a HDF5
+    file was opened whilst doing so"""
+    _File = h5py.File
+    _CountingFile.n_opens = 0
+    h5py.File = _CountingFile
+    try:
+        function(*args, **kwargs)
+    finally:
+        h5py.File = _File
+    return _CountingFile.n_opens
+
+
+def opens_per_shot(*filepaths):
+    """Count the HDF5 file opens and time taken to read each given shot file
+    into a row of the dataframe"""
+    if not filepaths:
+        raise ValueError('usage: opens_per_shot <shot file> [<shot file> ...]')
+    from lyse.dataframe_utilities import get_dataframe_from_shot, get_series_from_shot
+    for function in [get_dataframe_from_shot, get_series_from_shot]:
+        n_opens = 0
+        start_time = time.time()
+        for filepath in filepaths:
+            n_opens += count_opens(function, filepath)
+        elapsed = time.time() - start_time
+        print('%s: %.2f opens per shot, %.2f ms per shot' %
+              (function.__name__, n_opens / len(filepaths), 1e3 * elapsed / len(filepaths)))
+
+
+def _synthetic_rows(n_rows, n_columns=50):
+    """Flat dictionaries resembling shot data, with a mix of globals and
+    results of different depths"""
+    rows = []
+    for i in range(n_rows):
+        row = {('filepath',): 'shot_%06d.h5' % i, ('run number',): i}
+        for j in range(n_columns):
+            if j % 2:
+                row[('global_%d' % j,)] = float(i * j)
+            else:
+                row[('routine_%d' % (j % 5), 'result_%d' % j)] = float(i + j)
+        rows.append(row)
+    return rows
+
+
+def append(*sizes):
+    """Time appending rows to the dataframe, in batches of 5 as lyse does when
+    shots arrive, using the DataFrameStore and using pandas.concat"""
+    from lyse.dataframe_store import DataFrameStore
+    from lyse.dataframe_utilities import concat_with_padding, flat_dict_to_hierarchical_dataframe
+    sizes = [int(size) for size in sizes] or [1000, 10000, 100000]
+    batch_size = 5
+    for n_rows in sizes:
+        rows = _synthetic_rows(n_rows)
+        store = DataFrameStore()
+        start_time = time.time()
+        for i in range(0, n_rows, batch_size):
+            store.append_rows(rows[i:i + batch_size])
+        store.to_dataframe()
+        elapsed = time.time() - start_time
+        print('DataFrameStore, %d rows: %.3f s (%.1f us per row)' % (n_rows, elapsed, 1e6 * elapsed / n_rows))
+        if n_rows > 10000:
+            print('pandas.concat, %d rows: skipped (too slow)' % n_rows)
+            continue
+        dataframe = flat_dict_to_hierarchical_dataframe(rows[0])
+        start_time = time.time()
+        for i in range(1, n_rows, batch_size):
+            new_rows = [flat_dict_to_hierarchical_dataframe(row) for row in rows[i:i + batch_size]]
+            dataframe = concat_with_padding(dataframe, *new_rows)
+        elapsed = time.time() - start_time
+        print('pandas.concat, %d rows: %.3f s (%.1f us per row)' % (n_rows, elapsed, 1e6 * elapsed / n_rows))
+
+
+def update(*sizes):
+    """Time updating a single row with new results, as lyse does after each
+    analysis routine runs, with varying numbers of rows in the dataframe.
+    Compares DataFrameStore.update_row() with replace_with_padding()"""
+    from lyse.dataframe_store import DataFrameStore
+    from lyse.dataframe_utilities import (replace_with_padding, flat_dict_to_hierarchical_dataframe,
+                                          concat_with_padding)
+    sizes = [int(size) for size in sizes] or [1000, 10000, 100000]
+    n_updates = 100
+    for n_rows in sizes:
+        rows = _synthetic_rows(n_rows)
+        store = DataFrameStore()
+        store.append_rows(rows)
+        start_time = time.time()
+        for i in range(n_updates):
+            index = (i * 7919) % n_rows
+            new_row = dict(rows[index])
+            new_row[('new_routine', 'result')] = float(i)
+            store.update_row(index, new_row)
+        elapsed = time.time() - start_time
+        print('DataFrameStore.update_row, %d rows: %.1f us per update' % (n_rows, 1e6 * elapsed / n_updates))
+        if n_rows > 10000:
+            print('replace_with_padding, %d rows: skipped (too slow)' % n_rows)
+            continue
+        dataframe = concat_with_padding(*[flat_dict_to_hierarchical_dataframe(row) for row in rows])
+        start_time = time.time()
+        for i in range(n_updates):
+            index = (i * 7919) % n_rows
+            new_row = dict(rows[index])
+            new_row[('new_routine', 'result')] = float(i)
+            dataframe = replace_with_padding(dataframe, flat_dict_to_hierarchical_dataframe(new_row), index)
+        elapsed = time.time() - start_time
+        print('replace_with_padding, %d rows: %.1f us per update' % (n_rows, 1e6 * elapsed / n_updates))
+
+
+def get_dataframe(*sizes):
+    """Time the server's side of a 'get dataframe' request, with varying
+    numbers of rows in the dataframe, after a row has been updated so that
+    nothing cached can be reused. Compares the DataFrameStore's typed
+    columns with converting a dataframe of object columns with
+    convert_objects() on each request, as lyse used to."""
+    import pandas
+    from lyse.dataframe_store import DataFrameStore
+    sizes = [int(size) for size in sizes] or [1000, 10000, 100000]
+    n_requests = 10
+    for n_rows in sizes:
+        rows = _synthetic_rows(n_rows)
+        store = DataFrameStore()
+        store.append_rows(rows)
+        start_time = time.time()
+        for i in range(n_requests):
+            store.set_value(i, 'run number', i)
+            pickle.dumps(store.to_dataframe(), pickle.HIGHEST_PROTOCOL)
+        elapsed = time.time() - start_time
+        print('typed columns, %d rows: %.1f ms per request' % (n_rows, 1e3 * elapsed / n_requests))
+        if not hasattr(pandas.DataFrame, 'convert_objects'):
+            print('convert_objects, %d rows: skipped (not available in this version of pandas)' % n_rows)
+            continue
+        dataframe = store.to_dataframe().astype(object)
+        start_time = time.time()
+        for i in range(n_requests):
+            converted = dataframe.convert_objects(convert_dates=False, convert_numeric=False,
+                                                  convert_timedeltas=False)
+            pickle.dumps(converted, pickle.HIGHEST_PROTOCOL)
+        elapsed = time.time() - start_time
+        print('convert_objects, %d rows: %.1f ms per request' % (n_rows, 1e3 * elapsed / n_requests))
+
+
+benchmarks = {'opens_per_shot': opens_per_shot,
+              'append': append,
+              'update': update,
+              'get_dataframe': get_dataframe}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(__doc__)
+        print('Available benchmarks:\n  ' + '\n  '.join(sorted(benchmarks)))
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*sys.argv[2:])
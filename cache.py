@@ -0,0 +1,386 @@
+#####################################################################
+#                                                                   #
+# /cache.py                                                         #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+"""Caches for analysis routines, that persist from one run of a routine to
+the next when it is run from within lyse. They are bounded in size, can
+expire entries after a time, and can spill evicted entries to disk. They are
+intended for expensive setup, such as loading calibration files and
+background images or building fit templates, that only needs to be redone
+when the things it depends on change. For example, to build a fit template
+only once per distinct value of the globals it depends on:
+
+    import lyse
+
+    @lyse.cache.memoize_globals('imaging_detuning', 'tof_time')
+    def make_template(imaging_detuning, tof_time):
+        ...
+
+    template = make_template(lyse.path)
+
+or to load each background image only once:
+
+    @lyse.cache.memoize(maxbytes=500e6)
+    def load_background(filename):
+        ...
+
+Caches are kept per routine, and are looked up by name each time the
+routine runs, so the decorators above return the same cache on every shot
+even though the routine, and so the decorator, is run again each time. Call
+lyse.cache.report() for the hit rate and memory use of each cache. As with
+lyse.routine_storage, caches are not retained if the routine is run from the
+command line instead of lyse, or its worker process is restarted."""
+
+import os
+import sys
+import time
+import hashlib
+import inspect
+import threading
+import functools
+import cPickle as pickle
+from collections import OrderedDict
+
+import labscript_utils.h5_lock, h5py
+
+from lyse.dataframe_utilities import get_shot_globals
+
+
+def sizeof(value):
+    """An estimate of the memory used by a value in bytes. NumPy arrays and
+    pandas objects are counted by the size of their data, and containers
+    include the sizes of their contents."""
+    memory_usage = getattr(value, 'memory_usage', None)
+    if memory_usage is not None:
+        try:
+            # pandas DataFrame or Series:
+            usage = memory_usage(deep=True)
+            return int(getattr(usage, 'sum', lambda: usage)())
+        except TypeError:
+            # Older pandas without deep=True. Count the data, with object
+            # columns counted by their pointers only, and the index:
+            values = getattr(value, 'values', None)
+            index = getattr(value, 'index', None)
+            if isinstance(getattr(values, 'nbytes', None), (int, long)) and index is not None:
+                return values.nbytes + sizeof(index)
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, (int, long)):
+        # NumPy array:
+        return nbytes
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sizeof(item) for item in value)
+    return size
+
+
+def _hashable(value):
+    """Return a hashable equivalent of a value, for use in cache keys"""
+    if hasattr(value, 'tobytes') and hasattr(value, 'dtype'):
+        return ('ndarray', str(value.dtype), value.shape, value.tobytes())
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(_hashable(item) for item in value)
+    return value
+
+
+class Cache(object):
+    """A dictionary-like cache with least-recently-used eviction. Entries
+    are evicted when there are more than maxsize of them or their total
+    size, as estimated by sizeof(), exceeds maxbytes, and expire ttl seconds
+    after being stored. Any of these may be None for no limit. If spill_dir
+    is given, evicted entries are pickled to files in that directory rather
+    than discarded, and are loaded back into memory the next time they are
+    looked up. Keys must be hashable, and also picklable if spill_dir is
+    given.
+
+    All methods are thread-safe."""
+
+    def __init__(self, maxsize=None, maxbytes=None, ttl=None, spill_dir=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+        self.lock = threading.RLock()
+        # (value, size, time stored) by key, least recently used first:
+        self.entries = OrderedDict()
+        # (filepath, time stored) of spilled entries by key:
+        self.spilled = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expired(self, stored_time):
+        return self.ttl is not None and time.time() - stored_time > self.ttl
+
+    def _spill_path(self, key):
+        key_hash = hashlib.sha1(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)).hexdigest()
+        return os.path.join(self.spill_dir, key_hash + '.pickle')
+
+    def _remove(self, key):
+        value, size, stored_time = self.entries.pop(key)
+        self.nbytes -= size
+        return value, stored_time
+
+    def _remove_spilled(self, key):
+        filepath, stored_time = self.spilled.pop(key)
+        try:
+            os.unlink(filepath)
+        except OSError:
+            pass
+        return filepath, stored_time
+
+    def _evict(self):
+        """Evict least recently used entries until within bounds"""
+        while self.entries and ((self.maxsize is not None and len(self.entries) > self.maxsize) or
+                                (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            key = next(iter(self.entries))
+            value, stored_time = self._remove(key)
+            self.evictions += 1
+            if self.spill_dir is not None and not self._expired(stored_time):
+                filepath = self._spill_path(key)
+                try:
+                    with open(filepath, 'wb') as f:
+                        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+                except (pickle.PicklingError, TypeError, IOError):
+                    # Can't be spilled, just discard it:
+                    continue
+                self.spilled[key] = filepath, stored_time
+
+    def _store(self, key, value, stored_time):
+        if key in self.entries:
+            self._remove(key)
+        size = sizeof(value)
+        self.entries[key] = value, size, stored_time
+        self.nbytes += size
+        self._evict()
+
+    def _lookup(self, key):
+        """Return (True, value) if the key is in the cache, or (False, None)
+        if not. Does not count hits or misses."""
+        if key in self.entries:
+            value, size, stored_time = self.entries[key]
+            if self._expired(stored_time):
+                self._remove(key)
+                return False, None
+            # Mark as most recently used:
+            del self.entries[key]
+            self.entries[key] = value, size, stored_time
+            return True, value
+        if key in self.spilled:
+            filepath, stored_time = self.spilled[key]
+            if self._expired(stored_time):
+                self._remove_spilled(key)
+                return False, None
+            try:
+                with open(filepath, 'rb') as f:
+                    value = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                return False, None
+            finally:
+                self._remove_spilled(key)
+            self._store(key, value, stored_time)
+            return True, value
+        return False, None
+
+    def get(self, key, default=None):
+        with self.lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def __getitem__(self, key):
+        with self.lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.spilled:
+                self._remove_spilled(key)
+            self._store(key, value, time.time())
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            elif key in self.spilled:
+                self._remove_spilled(key)
+            else:
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.entries:
+                return not self._expired(self.entries[key][2])
+            if key in self.spilled:
+                return not self._expired(self.spilled[key][1])
+            return False
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries) + len(self.spilled)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.spilled):
+                self._remove_spilled(key)
+            self.entries.clear()
+            self.nbytes = 0
+
+    def get_or_compute(self, key, function, *args, **kwargs):
+        """Return the cached value for key, or if there is none, call
+        function(*args, **kwargs), cache the result and return it"""
+        with self.lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+        # Compute outside the lock, so that other threads can still use the
+        # cache in the meantime:
+        value = function(*args, **kwargs)
+        self[key] = value
+        return value
+
+    def stats(self):
+        """Return a dictionary of the cache's hit rate and memory use"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else None,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'spilled': len(self.spilled),
+                    'nbytes': self.nbytes}
+
+
+# Caches by routine name and cache name, so that routines get the same
+# caches back each time they run:
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _caller_routine():
+    """The name of the analysis routine calling into this module, from the
+    __file__ of the first frame outside it. This is the same name as the
+    results group the routine saves to."""
+    frame = inspect.currentframe()
+    try:
+        while frame is not None and frame.f_globals.get('__name__') == __name__:
+            frame = frame.f_back
+        if frame is None or '__file__' not in frame.f_globals:
+            return '<interactive>'
+        return os.path.basename(frame.f_globals['__file__']).split('.py')[0]
+    finally:
+        del frame
+
+
+def get_cache(name='default', maxsize=None, maxbytes=None, ttl=None, spill_dir=None):
+    """Return the calling routine's cache with the given name, creating it
+    with the given arguments (see Cache) if it does not already exist.
+    Arguments are ignored if it does."""
+    key = _caller_routine(), name
+    with _caches_lock:
+        try:
+            return _caches[key]
+        except KeyError:
+            cache = _caches[key] = Cache(maxsize, maxbytes, ttl, spill_dir)
+            return cache
+
+
+def memoize(function=None, maxsize=None, maxbytes=None, ttl=None, spill_dir=None):
+    """Decorator to cache the results of a pure function, keyed by its
+    arguments, in a cache named after the function. Can be used with or
+    without arguments, which are as for Cache. Arguments may be NumPy arrays,
+    lists or dictionaries as well as hashable values."""
+    if function is None:
+        return lambda function: memoize(function, maxsize, maxbytes, ttl, spill_dir)
+    cache = get_cache(function.__name__, maxsize, maxbytes, ttl, spill_dir)
+
+    @functools.wraps(function)
+    def memoized(*args, **kwargs):
+        key = _hashable(args), _hashable(kwargs)
+        return cache.get_or_compute(key, function, *args, **kwargs)
+    memoized.cache = cache
+    return memoized
+
+
+def memoize_globals(*names, **kwargs):
+    """Decorator to cache the results of a pure function of the given shot
+    globals, in a cache named after the function. The decorated function is
+    called with the values of the named globals as keyword arguments, and
+    should be passed either a shot's filepath, or a dictionary of its globals
+    such as returned by Run.get_globals(). It is only called if it has not
+    been called before with the same values of those globals. Keyword
+    arguments are as for Cache."""
+    def decorator(function):
+        cache = get_cache(function.__name__, **kwargs)
+
+        @functools.wraps(function)
+        def memoized(shot):
+            if isinstance(shot, dict):
+                shot_globals = shot
+            else:
+                with h5py.File(shot, 'r') as h5_file:
+                    shot_globals = get_shot_globals(h5_file)
+            try:
+                values = {name: shot_globals[name] for name in names}
+            except KeyError as e:
+                raise KeyError('Shot has no global %s' % str(e))
+            key = _hashable(values)
+            return cache.get_or_compute(key, function, **values)
+        memoized.cache = cache
+        return memoized
+    return decorator
+
+
+def stats():
+    """Return a dictionary of the stats of each cache, as returned by
+    Cache.stats(), by routine name and then cache name"""
+    with _caches_lock:
+        caches = _caches.items()
+    result = {}
+    for (routine, name), cache in caches:
+        result.setdefault(routine, {})[name] = cache.stats()
+    return result
+
+
+def report():
+    """Return a summary of the hit rate and memory use of each cache, by
+    routine, as a string"""
+    lines = []
+    for routine, routine_stats in sorted(stats().items()):
+        total_nbytes = sum(cache_stats['nbytes'] for cache_stats in routine_stats.values())
+        lines.append('%s: %.1f MB' % (routine, total_nbytes / 1e6))
+        for name, cache_stats in sorted(routine_stats.items()):
+            if cache_stats['hit_rate'] is None:
+                hit_rate = 'no lookups'
+            else:
+                hit_rate = '%.1f%% hit rate' % (100 * cache_stats['hit_rate'])
+            lines.append('  %s: %s (%d hits, %d misses), %d entries, %d spilled, %d evictions, %.1f MB' %
+                         (name, hit_rate, cache_stats['hits'], cache_stats['misses'], cache_stats['entries'],
+                          cache_stats['spilled'], cache_stats['evictions'], cache_stats['nbytes'] / 1e6))
+    return '\n'.join(lines)
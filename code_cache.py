@@ -0,0 +1,53 @@
+#####################################################################
+#                                                                   #
+# /code_cache.py                                                    #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+import os
+import hashlib
+
+
+class CodeCache(object):
+    """A cache of compiled analysis routines, so that a routine run on many
+    shots is only read and compiled once. A routine is recompiled only if its
+    contents change. Its modification time and size are checked each time
+    it is run, and if either has changed the file is read and hashed, and
+    only recompiled if the hash differs too. Modules imported by routines
+    are not cached here, since the import statements are run anew each time,
+    so ModuleWatcher reloading of changed modules is unaffected."""
+
+    def __init__(self):
+        # (mtime, size), sha1 hash and code object, by routine filepath:
+        self.entries = {}
+
+    def get(self, filepath):
+        """Return the compiled code of the routine at the given filepath,
+        compiling it if it is not cached or has changed. Raises the same
+        exceptions as reading and compiling the file would."""
+        stat = os.stat(filepath)
+        key = stat.st_mtime, stat.st_size
+        try:
+            cached_key, cached_hash, code = self.entries[filepath]
+        except KeyError:
+            cached_key = cached_hash = code = None
+        if key == cached_key:
+            return code
+        with open(filepath, 'rb') as f:
+            source = f.read()
+        source_hash = hashlib.sha1(source).hexdigest()
+        if source_hash != cached_hash:
+            # Normalise line endings as execfile() does. dont_inherit=True so
+            # that the routine is compiled without any __future__ statements
+            # in effect here:
+            source = source.replace('\r\n', '\n').replace('\r', '\n')
+            code = compile(source, filepath, 'exec', 0, True)
+        self.entries[filepath] = key, source_hash, code
+        return code
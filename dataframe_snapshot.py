@@ -0,0 +1,197 @@
+#####################################################################
+#                                                                   #
+# /dataframe_snapshot.py                                            #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+"""Snapshots of the lyse dataframe on disk, for transferring the dataframe to
+clients on the same host without pickling it. A snapshot is a directory
+containing, for each numeric datatype, a .npy file of a 2D array of all the
+columns with that datatype, which clients memory-map read-only, a pickle of
+a 2D array of the remaining columns, and a pickle of metadata describing
+the columns. Snapshots are written to a temporary directory and renamed into
+place, so a snapshot directory that exists is always complete, and is never
+modified after it is written. Since reading a snapshot unpickles its files,
+snapshots are written to a private directory, and are only read if they are
+owned by the user reading them and can't be modified by anyone else."""
+
+import os
+import stat
+import shutil
+import tempfile
+import threading
+import cPickle as pickle
+
+import numpy as np
+import pandas
+
+METADATA_FILENAME = 'metadata.pickle'
+OBJECTS_FILENAME = 'objects.pickle'
+
+
+def _copy_blocks(store):
+    """Return the column names of the store and a dictionary mapping each
+    datatype to a (names, block) tuple, where block is a new array of shape
+    (len(names), nrows) containing the columns of that datatype. Must be
+    called with the store's lock held."""
+    names = sorted(store.columns)
+    nrows = len(store)
+    names_by_dtype = {}
+    for name in names:
+        names_by_dtype.setdefault(store.columns[name].dtype, []).append(name)
+    blocks = {}
+    for dtype, block_names in names_by_dtype.items():
+        block = np.empty((len(block_names), nrows), dtype=dtype)
+        for i, name in enumerate(block_names):
+            block[i] = store.columns[name][:nrows]
+        blocks[dtype] = block_names, block
+    return names, blocks
+
+
+def write_snapshot(store, directory):
+    """Write a snapshot of the contents of a DataFrameStore to a new
+    directory with the given path"""
+    # Only copy the data whilst holding the lock, so as not to hold up other
+    # users of the store whilst writing files:
+    with store.lock:
+        names, blocks = _copy_blocks(store)
+        metadata = {'version': store.version, 'nlevels': store.nlevels, 'nrows': len(store),
+                    'names': names, 'blocks': [], 'objects': []}
+    temp_directory = directory + '.tmp'
+    os.mkdir(temp_directory, 0o700)
+    objects = None
+    for i, dtype in enumerate(sorted(blocks, key=str)):
+        block_names, block = blocks[dtype]
+        if dtype == object:
+            objects = block
+            metadata['objects'] = block_names
+        else:
+            filename = 'block_%d.npy' % i
+            np.save(os.path.join(temp_directory, filename), block)
+            metadata['blocks'].append((filename, block_names))
+    with open(os.path.join(temp_directory, OBJECTS_FILENAME), 'wb') as f:
+        pickle.dump(objects, f, pickle.HIGHEST_PROTOCOL)
+    # Metadata last, since its presence marks the snapshot as complete:
+    with open(os.path.join(temp_directory, METADATA_FILENAME), 'wb') as f:
+        pickle.dump(metadata, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_directory, directory)
+
+
+def _block_frame(block, names):
+    # Since the frame stores its data as an array of shape (ncolumns, nrows),
+    # the transpose of which is block.T, its data is block itself, not a copy:
+    return pandas.DataFrame(block.T, columns=pandas.MultiIndex.from_tuples(names), copy=False)
+
+
+def _check_ownership(directory):
+    """Raise IOError if the directory is not owned by the current user, or
+    if others may write to it"""
+    if not hasattr(os, 'getuid'):
+        # Windows, where temporary directories are private to each user:
+        return
+    status = os.stat(directory)
+    if status.st_uid != os.getuid() or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise IOError('snapshot %s is not private to this user, refusing to read it' % directory)
+
+
+def read_snapshot(directory, read_only=False):
+    """Return a pandas DataFrame of the snapshot in the given directory.
+    Numeric columns are read by memory-mapping the files of each datatype
+    rather than reading them in. The maps are copy-on-write, so the
+    DataFrame may be modified without modifying the snapshot.
+
+    If read_only is True, the maps are read-only, and are used by the
+    DataFrame as its data without being copied, which is faster and uses
+    less memory for large dataframes. However, the DataFrame's numeric
+    columns then can't be modified in place, and its columns are grouped by
+    datatype rather than sorted, since reordering them would copy them.
+
+    Raises IOError if the snapshot is not private to the current user."""
+    _check_ownership(directory)
+    with open(os.path.join(directory, METADATA_FILENAME), 'rb') as f:
+        metadata = pickle.load(f)
+    with open(os.path.join(directory, OBJECTS_FILENAME), 'rb') as f:
+        objects = pickle.load(f)
+    if not metadata['names']:
+        names = [('filepath',) + ('',) * (metadata['nlevels'] - 1)]
+        return pandas.DataFrame({names[0]: []}, columns=pandas.MultiIndex.from_tuples(names))
+    if not metadata['nrows']:
+        # Empty files can't be memory-mapped:
+        mmap_mode = None
+    elif read_only:
+        mmap_mode = 'r'
+    else:
+        mmap_mode = 'c'
+    frames = []
+    for filename, names in metadata['blocks']:
+        block = np.load(os.path.join(directory, filename), mmap_mode=mmap_mode)
+        frames.append(_block_frame(block, names))
+    if objects is not None:
+        frames.append(_block_frame(objects, metadata['objects']))
+    if len(frames) == 1:
+        df = frames[0]
+    else:
+        df = pandas.concat(frames, axis=1, copy=False)
+    if read_only:
+        return df
+    # Put the columns back in the order of the lyse dataframe:
+    return df.reindex(columns=pandas.MultiIndex.from_tuples(metadata['names']))
+
+
+class SnapshotWriter(object):
+    """Writes snapshots of a DataFrameStore to subdirectories of a new
+    temporary directory private to the current user, reusing the latest
+    snapshot if the store has not changed since it was written. The most
+    recent few snapshots are kept, so that clients that have been told the
+    path of one have time to map it before it is deleted; on Windows, ones
+    still mapped by clients cannot be deleted, and deletion is retried
+    later. close() deletes the directory and all snapshots in it.
+
+    All methods are thread-safe."""
+
+    def __init__(self, keep=3):
+        self.keep = keep
+        self.lock = threading.Lock()
+        # Only accessible by the current user:
+        self.root_directory = tempfile.mkdtemp(prefix='lyse_snapshots_')
+        # The paths of existing snapshots, oldest first:
+        self.snapshots = []
+        # The store and version of the latest snapshot:
+        self.latest = None
+
+    def get_snapshot(self, store):
+        """Return the path of a snapshot of the current contents of the given
+        store, writing one if necessary"""
+        with self.lock:
+            if self.latest == (id(store), store.version):
+                return self.snapshots[-1]
+            # The version is read before writing the snapshot, so that if the
+            # store is modified in the meantime, the snapshot will be
+            # rewritten next time rather than wrongly reused:
+            version = store.version
+            directory = tempfile.mkdtemp(prefix='v%d-' % version, dir=self.root_directory)
+            os.rmdir(directory)
+            write_snapshot(store, directory)
+            self.snapshots.append(directory)
+            self.latest = (id(store), version)
+            self.delete_old_snapshots()
+            return directory
+
+    def delete_old_snapshots(self):
+        for directory in self.snapshots[:-self.keep]:
+            shutil.rmtree(directory, ignore_errors=True)
+            if not os.path.exists(directory):
+                self.snapshots.remove(directory)
+
+    def close(self):
+        with self.lock:
+            shutil.rmtree(self.root_directory, ignore_errors=True)
+            self.snapshots = []
+            self.latest = None
@@ -0,0 +1,587 @@
+#####################################################################
+#                                                                   #
+# /dataframe_store.py                                               #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+import uuid
+import operator
+import threading
+
+import numpy as np
+import pandas
+
+# Number of rows the column buffers are allocated with to begin with. They
+# double in size every time they fill up:
+INITIAL_CAPACITY = 64
+
+# The datatype of a column's buffer for each kind of column. An 'empty'
+# column is one that was added when the store had no rows, and so is
+# promoted to the kind of the first values written to it. Missing values
+# are NaN, so only 'float' and 'object' columns can have them:
+DTYPES = {'empty': np.float64,
+          'bool': np.bool_,
+          'int': np.int64,
+          'float': np.float64,
+          'object': object}
+
+# Kinds of values by type, for the common types, to save isinstance()
+# checks:
+_KINDS_BY_TYPE = {bool: 'bool', np.bool_: 'bool',
+                  int: 'int', np.int64: 'int', np.int32: 'int',
+                  float: 'float', np.float64: 'float', np.float32: 'float',
+                  str: 'object', unicode: 'object'}
+
+_INT64_MIN = np.iinfo(np.int64).min
+_INT64_MAX = np.iinfo(np.int64).max
+
+
+def _kind(value):
+    """Return the kind of column needed to hold a value without converting
+    it to a different kind of value"""
+    kind = _KINDS_BY_TYPE.get(type(value))
+    if kind is not None:
+        return kind
+    if isinstance(value, (bool, np.bool_)):
+        return 'bool'
+    if isinstance(value, (int, long, np.integer)):
+        if _INT64_MIN <= value <= _INT64_MAX:
+            return 'int'
+        return 'object'
+    if isinstance(value, (float, np.floating)):
+        return 'float'
+    return 'object'
+
+
+def _array_kind(values):
+    """Return the kind of column needed to hold the values in an array"""
+    if values.dtype.kind == 'b':
+        return 'bool'
+    if values.dtype.kind in 'iu' and values.dtype.itemsize <= 8:
+        return 'int'
+    if values.dtype.kind == 'f':
+        return 'float'
+    return 'object'
+
+
+def _promoted_kind(kind, new_kind):
+    """Return the kind of column needed to hold both values of the given
+    kind and values of the new kind, which may be 'missing' for NaNs. Ints
+    are promoted to floats, as pandas does, and so are ints and bools
+    with missing values, but mixtures of bools with other values are
+    objects."""
+    if new_kind == kind:
+        return kind
+    if kind == 'empty':
+        return 'float' if new_kind == 'missing' else new_kind
+    if new_kind == 'missing':
+        return 'object' if kind == 'bool' else 'float' if kind == 'int' else kind
+    if {kind, new_kind} == {'int', 'float'}:
+        return 'float'
+    return 'object'
+
+
+def _new_buffer(capacity, kind):
+    buffer = np.empty(capacity, dtype=DTYPES[kind])
+    if kind in ('empty', 'float', 'object'):
+        buffer.fill(np.nan)
+    return buffer
+
+
+def _same_value(a, b):
+    """Whether two cell values are the same, for the purpose of deciding
+    whether a cell needs updating. NaNs are considered equal to each other."""
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, np.ndarray):
+        return a.dtype == b.dtype and np.array_equal(a, b)
+    if isinstance(a, float) and a != a and b != b:
+        return True
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+def _same_cell(buffer, index, value):
+    """Whether the cell of a buffer at the given index already holds the
+    given value, as it would be stored in the buffer"""
+    stored = buffer[index]
+    if buffer.dtype != object:
+        # The value would be converted to the buffer's datatype:
+        value = buffer.dtype.type(value)
+        return bool(stored == value or (stored != stored and value != value))
+    return _same_value(stored, value)
+
+
+def _in(values, collection):
+    return np.array([value in collection for value in values], dtype=bool)
+
+
+# Comparison operators that can be used in filters passed to
+# DataFrameStore.select():
+FILTER_OPERATORS = {'==': operator.eq,
+                    '!=': operator.ne,
+                    '<': operator.lt,
+                    '<=': operator.le,
+                    '>': operator.gt,
+                    '>=': operator.ge,
+                    'in': _in}
+
+
+def _compare(values, op, value):
+    """Return a boolean array of whether each element of the array values
+    compares to the given value with the given operator. Elements
+    that can't be compared compare False."""
+    try:
+        function = FILTER_OPERATORS[op]
+    except KeyError:
+        raise ValueError('Invalid filter operator %r. Valid operators are: %s' %
+                         (op, ', '.join(sorted(FILTER_OPERATORS))))
+    try:
+        with np.errstate(invalid='ignore'):
+            result = np.asarray(function(values, value), dtype=bool)
+        if result.shape == values.shape:
+            return result
+    except Exception:
+        pass
+    # Fall back to comparing elements one at a time:
+    result = np.zeros(len(values), dtype=bool)
+    for i, element in enumerate(values):
+        try:
+            result[i] = function(element, value)
+        except Exception:
+            pass
+    return result
+
+
+class DataFrameStore(object):
+    """An append-optimised, columnar store of shot data. Each column is a
+    growable NumPy buffer, which doubles in size whenever it fills up, so that
+    appending a row costs amortised O(1) per column regardless of how many
+    rows are already present. Rows are flat dictionaries as returned by
+    dataframe_utilities.flatten_dict(), whose keys are tuples of strings, one
+    element per level of the hierarchy. Column names are stored padded with
+    empty strings to the depth of the deepest key seen so far, and are
+    re-padded if a deeper key arrives, exactly as they would be in a pandas
+    DataFrame with MultiIndex columns. A pandas DataFrame is only
+    materialised when one is asked for, and is cached until the store is next
+    modified.
+
+    Each column has a kind, one of the keys of DTYPES, which determines the
+    datatype of its buffer. A column's kind is only ever promoted, when a
+    value arrives that its buffer can't hold, for example an int column
+    becomes a float column when a float or a missing value is written to it,
+    and any column becomes an object column when a string is. So the buffers
+    are always ready to be used as the columns of a DataFrame without
+    inferring their datatypes, and bool, int and float columns are stored
+    compactly.
+
+    The store keeps a version number that is incremented on every
+    modification, and records the version at which each row and each column
+    last changed, so that clients holding a copy can be sent only what
+    changed since the version they have (see get_changes() and
+    apply_changes()).
+
+    All methods are thread-safe."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Number of rows in the store, and number of rows the buffers
+        # currently have room for:
+        self.nrows = 0
+        self.capacity = INITIAL_CAPACITY
+        # How many levels the column names have. Must have at least two
+        # levels to make a MultiIndex:
+        self.nlevels = 2
+        # Column buffers and kinds by padded column name:
+        self.columns = {}
+        self.kinds = {}
+        # The cached materialised DataFrame:
+        self._dataframe = None
+        # Incremented every time the store is modified:
+        self.version = 0
+        # The version at which each row and column last changed:
+        self.row_versions = np.zeros(self.capacity, dtype=np.int64)
+        self.column_versions = {}
+        # Incremented every time rows are removed or column names change
+        # depth, after which rows and columns can't be matched up with those
+        # of an earlier version. Along with the store's unique id, this
+        # identifies whether a client's copy can be updated or must be
+        # replaced:
+        self.structure_version = 0
+        self.uid = uuid.uuid4().hex
+
+    def _modified(self, rows=None, columns=()):
+        """Increment the version, recording it as the version at which the
+        given rows and columns changed. rows may be anything that can be used
+        to index an array."""
+        self._dataframe = None
+        self.version += 1
+        if rows is not None:
+            self.row_versions[rows] = self.version
+        for name in columns:
+            self.column_versions[name] = self.version
+
+    def _reserve(self, nrows):
+        """Ensure the buffers have room for at least nrows rows"""
+        if nrows <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < nrows:
+            capacity *= 2
+        for name, buffer in self.columns.items():
+            new_buffer = _new_buffer(capacity, self.kinds[name])
+            new_buffer[:self.nrows] = buffer[:self.nrows]
+            self.columns[name] = new_buffer
+        row_versions = np.zeros(capacity, dtype=np.int64)
+        row_versions[:self.nrows] = self.row_versions[:self.nrows]
+        self.row_versions = row_versions
+        self.capacity = capacity
+
+    def _promote(self, name, kind):
+        """Promote the kind of the named column if necessary so that it can
+        hold values of the given kind, or missing values if kind is
+        'missing'"""
+        old_kind = self.kinds[name]
+        kind = _promoted_kind(old_kind, kind)
+        if kind != old_kind:
+            buffer = _new_buffer(self.capacity, kind)
+            if old_kind != 'empty':
+                buffer[:self.nrows] = self.columns[name][:self.nrows]
+            self.columns[name] = buffer
+            self.kinds[name] = kind
+
+    def _add_levels(self, nlevels):
+        """Pad all column names with empty strings to the new depth"""
+        extra_levels = nlevels - self.nlevels
+        self.columns = {name + ('',) * extra_levels: buffer for name, buffer in self.columns.items()}
+        self.kinds = {name + ('',) * extra_levels: kind for name, kind in self.kinds.items()}
+        self.column_versions = {name + ('',) * extra_levels: version
+                                for name, version in self.column_versions.items()}
+        self.nlevels = nlevels
+        self.structure_version += 1
+
+    def pad(self, name):
+        """Return the given column name padded to the current depth of the
+        store's column names. Unpadded names as produced by flatten_dict() and
+        already padded names are both accepted."""
+        if not isinstance(name, tuple):
+            name = (name,)
+        return name + ('',) * (self.nlevels - len(name))
+
+    def add_column(self, name):
+        """Add a column of NaNs if it does not already exist and return its
+        padded name"""
+        with self.lock:
+            if not isinstance(name, tuple):
+                name = (name,)
+            if len(name) > self.nlevels:
+                self._add_levels(len(name))
+            name = self.pad(name)
+            if name not in self.columns:
+                # The column has missing values in any existing rows:
+                kind = 'float' if self.nrows else 'empty'
+                self.columns[name] = _new_buffer(self.capacity, kind)
+                self.kinds[name] = kind
+                self._modified(columns=[name])
+            return name
+
+    @property
+    def column_names(self):
+        with self.lock:
+            return list(self.columns)
+
+    def __len__(self):
+        return self.nrows
+
+    def append_rows(self, rows):
+        """Append rows, each a flat dictionary of column names to values.
+        Columns not present in a row are filled with NaN. Returns the index of
+        the first appended row."""
+        with self.lock:
+            start = self.nrows
+            self._reserve(self.nrows + len(rows))
+            # The new values of each column, by unpadded column name, so that
+            # each column's kind can be promoted once for all of them. Values
+            # missing from a row are NaN:
+            columns = {}
+            for i, row in enumerate(rows):
+                for name, value in row.items():
+                    try:
+                        columns[name][i] = value
+                    except KeyError:
+                        columns[name] = [np.nan] * len(rows)
+                        columns[name][i] = value
+            # Add any new columns first, so that all names are padded to the
+            # final depth:
+            for name in columns:
+                self.add_column(name)
+            padded_names = []
+            for name, values in columns.items():
+                padded_name = self.pad(name)
+                padded_names.append(padded_name)
+                value_kinds = set(_KINDS_BY_TYPE.get(type_) for type_ in set(map(type, values)))
+                if None in value_kinds:
+                    # Not all common types, check each value:
+                    value_kinds = set(map(_kind, values))
+                kind = self.kinds[padded_name]
+                for value_kind in value_kinds:
+                    kind = _promoted_kind(kind, value_kind)
+                self._promote(padded_name, kind)
+                buffer = self.columns[padded_name]
+                if kind == 'object':
+                    # Assign one at a time so that values that are sequences
+                    # are stored as they are:
+                    for i, value in enumerate(values, start):
+                        buffer[i] = value
+                else:
+                    buffer[start:start + len(rows)] = values
+            if rows:
+                # Columns not in any of the new rows have missing values in
+                # all of them:
+                for name in set(self.columns).difference(padded_names):
+                    self._promote(name, 'missing')
+            self.nrows += len(rows)
+            self._modified(slice(start, self.nrows), padded_names)
+            return start
+
+    def update_row(self, index, row, clear_missing=True):
+        """Update the row at the given index in-place so that its contents
+        match the given flat dictionary. Only cells whose values differ are
+        written, new columns are only added for keys not seen before, and rows
+        are never reordered, so the cost does not depend on the number of
+        rows. Columns missing from the new row are set to NaN, unless
+        clear_missing is False. Returns a list of the padded names of the
+        columns whose values changed."""
+        with self.lock:
+            # Add any new columns first, so that all names are padded to the
+            # final depth:
+            for name in row:
+                self.add_column(name)
+            changed = []
+            new_names = set()
+            for name, value in row.items():
+                name = self.pad(name)
+                new_names.add(name)
+                self._promote(name, _kind(value))
+                buffer = self.columns[name]
+                if not _same_cell(buffer, index, value):
+                    buffer[index] = value
+                    changed.append(name)
+            if clear_missing:
+                for name in list(self.columns):
+                    if name in new_names:
+                        continue
+                    # Promote first, since bool and int columns can't hold
+                    # NaN, and so can't be compared with it either:
+                    self._promote(name, 'missing')
+                    if not _same_cell(self.columns[name], index, np.nan):
+                        self.columns[name][index] = np.nan
+                        changed.append(name)
+            if changed:
+                self._modified([index], changed)
+            return changed
+
+    def remove_rows(self, indices):
+        """Remove the rows at the given indices. Subsequent rows move up to
+        fill the gaps."""
+        with self.lock:
+            indices = sorted(set(indices))
+            if not indices:
+                return
+            keep = np.ones(self.nrows, dtype=bool)
+            keep[indices] = False
+            nrows = int(keep.sum())
+            for name, buffer in self.columns.items():
+                buffer[:nrows] = buffer[:self.nrows][keep]
+                if self.kinds[name] in ('float', 'object'):
+                    buffer[nrows:self.nrows] = np.nan
+            self.row_versions[:nrows] = self.row_versions[:self.nrows][keep]
+            self.row_versions[nrows:self.nrows] = 0
+            self.nrows = nrows
+            self.structure_version += 1
+            self._modified()
+
+    def get_value(self, index, name):
+        with self.lock:
+            return self.columns[self.pad(name)][index]
+
+    def set_value(self, index, name, value):
+        with self.lock:
+            name = self.add_column(name)
+            self._promote(name, _kind(value))
+            self.columns[name][index] = value
+            self._modified([index], [name])
+
+    def get_column(self, name):
+        """Return a copy of the values in the given column"""
+        with self.lock:
+            return self.columns[self.pad(name)][:self.nrows].copy()
+
+    def get_row(self, index):
+        """Return the row at the given index as a dictionary of padded column
+        names to values"""
+        with self.lock:
+            return {name: buffer[index] for name, buffer in self.columns.items()}
+
+    @property
+    def token(self):
+        """A token identifying the current contents of the store, for passing
+        to get_changes() later"""
+        with self.lock:
+            return self.uid, self.version, self.structure_version
+
+    def get_changes(self, token=None):
+        """Return the changes to the store since the version identified by
+        the given token, as previously returned by this method or the token
+        property. The result is a dictionary with keys:
+
+            'reset': whether all rows and columns are included, because the
+                     token was None, or was from a different store, or rows
+                     have since been removed or column names changed depth.
+            'nrows': the number of rows in the store.
+            'indices': an array of the indices of the rows that changed.
+            'values': the new values of the changed rows, as a dictionary of
+                      arrays aligned with 'indices', by padded column name.
+                      Only columns that changed are included.
+            'token': the token of the current version.
+
+        The cost is proportional to the size of the changes, other than a
+        fast scan of the row versions."""
+        with self.lock:
+            if (token is None or token[0] != self.uid or token[2] != self.structure_version
+                    or token[1] > self.version):
+                reset = True
+                indices = np.arange(self.nrows)
+                names = list(self.columns)
+            else:
+                reset = False
+                version = token[1]
+                indices = np.flatnonzero(self.row_versions[:self.nrows] > version)
+                names = [name for name, column_version in self.column_versions.items() if column_version > version]
+            values = {name: self.columns[name][indices] for name in names}
+            return {'reset': reset, 'nrows': self.nrows, 'indices': indices,
+                    'values': values, 'token': self.token}
+
+    def apply_changes(self, changes):
+        """Apply changes as returned by get_changes() on another store, so
+        that the contents of this store match that one's"""
+        with self.lock:
+            if changes['reset']:
+                self.nrows = 0
+                self.nlevels = 2
+                self.columns = {}
+                self.kinds = {}
+                self.column_versions = {}
+                self.structure_version += 1
+            self._reserve(changes['nrows'])
+            for name in changes['values']:
+                self.add_column(name)
+            names = []
+            for name, values in changes['values'].items():
+                name = self.pad(name)
+                self._promote(name, _array_kind(values))
+                self.columns[name][changes['indices']] = values
+                names.append(name)
+            if changes['nrows'] > self.nrows:
+                # Columns that didn't change have missing values in the new
+                # rows:
+                for name in set(self.columns).difference(names):
+                    self._promote(name, 'missing')
+            self.nrows = changes['nrows']
+            self._modified(changes['indices'], names)
+
+    def _make_dataframe(self, names, rows):
+        """Return a DataFrame of the given rows (anything that can be used to
+        index an array) of the given columns"""
+        if not names:
+            names = [self.pad('filepath')]
+        index = pandas.MultiIndex.from_tuples(names)
+        data = {}
+        for name in names:
+            if name in self.columns:
+                data[name] = self.columns[name][:self.nrows][rows]
+            else:
+                data[name] = []
+        return pandas.DataFrame(data, columns=index)
+
+    def to_dataframe(self):
+        """Return the contents of the store as a pandas DataFrame with
+        MultiIndex columns. The result is cached until the store is next
+        modified, and should not be modified by the caller."""
+        with self.lock:
+            if self._dataframe is None:
+                self._dataframe = self._make_dataframe(sorted(self.columns), slice(None))
+            return self._dataframe
+
+    def select(self, columns=None, sequence=None, filter=None, last_n=None):
+        """Return a pandas DataFrame of a subset of the store's contents,
+        without materialising the rest:
+
+            columns: a list of column names to include. The sequence and run
+                     time columns are always included, if present, so that the
+                     result can be indexed the same as the whole dataframe.
+            sequence: only include rows from this sequence, or any of these
+                      sequences if a list.
+            filter: a (column_name, operator, value) triple, or a list of
+                    them, of which all must be true for a row to be
+                    included. Operators are those in FILTER_OPERATORS. Cells
+                    that can't be compared with the value compare False.
+            last_n: only include the last n of the rows that would otherwise
+                    be included.
+
+        Column names may be given unpadded, as for add_column(). Raises
+        KeyError if a column does not exist, and ValueError for an invalid
+        filter."""
+        with self.lock:
+            include = np.ones(self.nrows, dtype=bool)
+            if sequence is not None:
+                if not isinstance(sequence, (list, tuple, set)):
+                    sequence = [sequence]
+                include &= _compare(self._get_buffer('sequence'), 'in', list(sequence))
+            if filter:
+                if len(filter) == 3 and isinstance(filter[1], basestring):
+                    # A single condition:
+                    filter = [filter]
+                for condition in filter:
+                    try:
+                        column_name, op, value = condition
+                    except (TypeError, ValueError):
+                        raise ValueError('Invalid filter condition %r, should be a '
+                                         '(column_name, operator, value) triple' % (condition,))
+                    include &= _compare(self._get_buffer(column_name), op, value)
+            indices = np.flatnonzero(include)
+            if last_n is not None:
+                indices = indices[len(indices) - min(max(int(last_n), 0), len(indices)):]
+            if columns is None:
+                names = sorted(self.columns)
+            else:
+                if isinstance(columns, basestring):
+                    columns = [columns]
+                names = []
+                for name in list(columns) + ['sequence', 'run time']:
+                    padded_name = self.pad(name)
+                    if padded_name not in self.columns:
+                        if name in columns:
+                            raise KeyError('No such column: %r' % (name,))
+                        continue
+                    if padded_name not in names:
+                        names.append(padded_name)
+            return self._make_dataframe(names, indices)
+
+    def _get_buffer(self, name):
+        """Return the values in the named column, without copying"""
+        try:
+            return self.columns[self.pad(name)][:self.nrows]
+        except KeyError:
+            raise KeyError('No such column: %r' % (name,))
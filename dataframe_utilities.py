@@ -18,60 +18,83 @@ from numpy import *
 import tzlocal
 import labscript_utils.shared_drive
 
-import runmanager
-
 def asdatetime(timestr):
     tz = tzlocal.get_localzone().zone
     return pandas.Timestamp(timestr, tz=tz)
 
-def get_nested_dict_from_shot(filepath):
-    row = runmanager.get_shot_globals(filepath)
-    with h5py.File(filepath,'r') as h5_file:
-        # if 'data' in h5_file:
-        #     for groupname in h5_file['data']:
-        #         resultsgroup = h5_file['data'][groupname]
-        #         if 'camera' in dict(resultsgroup.attrs).keys():
-        #             row[groupname] = h5_file['data'][groupname]['Raw'][:]
-        if 'results' in h5_file:
-            for groupname in h5_file['results']:
-                resultsgroup = h5_file['results'][groupname]
-                row[groupname] = dict(resultsgroup.attrs)
-        if 'images' in h5_file:
-            for orientation in h5_file['images'].keys():
-                if isinstance(h5_file['images'][orientation], h5py.Group):
-                    row[orientation] = dict(h5_file['images'][orientation].attrs)
-                    for label in h5_file['images'][orientation]:
-                        row[orientation][label] = {}
-                        group = h5_file['images'][orientation][label]
-                        for image in group:
-                            row[orientation][label][image] = {}
-                            for key, val in group[image].attrs.items():
-                                if not isinstance(val, h5py.Reference):
-                                    row[orientation][label][image][key] = val
-        row['filepath'] = filepath
-        row['agnostic_path'] = labscript_utils.shared_drive.path_to_agnostic(filepath)
-        row['sequence'] = asdatetime(h5_file.attrs['sequence_id'].split('_')[0])
-        try:
-            row['sequence_index'] = h5_file.attrs['sequence_index']
-        except:
-            row['sequence_index'] = float('nan')
-        if 'script' in h5_file:
-            row['labscript'] = h5_file['script'].attrs['name']
-        try:
-            row['run time'] = asdatetime(h5_file.attrs['run time'])
-        except KeyError:
-            row['run time'] = float('nan')
-        try:
-            row['run number'] = h5_file.attrs['run number']
-        except KeyError:
-            # ignore:
-            pass
-        try:
-            row['individual id'] = h5_file.attrs['individual id']
-            row['generation'] = h5_file.attrs['generation']
-        except KeyError:
-            pass
-        return row
+def get_shot_globals(h5_file):
+    """Returns the evaluated globals for a shot from an already open h5 file.
+    Equivalent to runmanager.get_shot_globals(), but without opening the
+    file a second time."""
+    params = {}
+    for name, value in h5_file['globals'].attrs.items():
+        # Convert numpy bools to normal bools:
+        if isinstance(value, bool_):
+            value = bool(value)
+        # Convert null HDF references to None:
+        if isinstance(value, h5py.Reference) and not value:
+            value = None
+        # Convert numpy strings to Python ones.
+        # DEPRECATED, for backward compat with old files.
+        if isinstance(value, str_):
+            value = str(value)
+        params[name] = value
+    return params
+
+def get_nested_dict_from_shot(filepath, h5_file=None):
+    """Reads the globals, results, image attributes and sequence metadata
+    of a shot into a nested dictionary. Everything is read through a single
+    file handle, so that each shot costs only one (locked) open. An already
+    open h5_file may be passed in, in which case it is used instead."""
+    if h5_file is None:
+        with h5py.File(filepath,'r') as h5_file:
+            return get_nested_dict_from_shot(filepath, h5_file)
+    row = get_shot_globals(h5_file)
+    # if 'data' in h5_file:
+    #     for groupname in h5_file['data']:
+    #         resultsgroup = h5_file['data'][groupname]
+    #         if 'camera' in dict(resultsgroup.attrs).keys():
+    #             row[groupname] = h5_file['data'][groupname]['Raw'][:]
+    if 'results' in h5_file:
+        for groupname in h5_file['results']:
+            resultsgroup = h5_file['results'][groupname]
+            row[groupname] = dict(resultsgroup.attrs)
+    if 'images' in h5_file:
+        for orientation in h5_file['images'].keys():
+            if isinstance(h5_file['images'][orientation], h5py.Group):
+                row[orientation] = dict(h5_file['images'][orientation].attrs)
+                for label in h5_file['images'][orientation]:
+                    row[orientation][label] = {}
+                    group = h5_file['images'][orientation][label]
+                    for image in group:
+                        row[orientation][label][image] = {}
+                        for key, val in group[image].attrs.items():
+                            if not isinstance(val, h5py.Reference):
+                                row[orientation][label][image][key] = val
+    row['filepath'] = filepath
+    row['agnostic_path'] = labscript_utils.shared_drive.path_to_agnostic(filepath)
+    row['sequence'] = asdatetime(h5_file.attrs['sequence_id'].split('_')[0])
+    try:
+        row['sequence_index'] = h5_file.attrs['sequence_index']
+    except:
+        row['sequence_index'] = float('nan')
+    if 'script' in h5_file:
+        row['labscript'] = h5_file['script'].attrs['name']
+    try:
+        row['run time'] = asdatetime(h5_file.attrs['run time'])
+    except KeyError:
+        row['run time'] = float('nan')
+    try:
+        row['run number'] = h5_file.attrs['run number']
+    except KeyError:
+        # ignore:
+        pass
+    try:
+        row['individual id'] = h5_file.attrs['individual id']
+        row['generation'] = h5_file.attrs['generation']
+    except KeyError:
+        pass
+    return row
 
 def flatten_dict(dictionary, keys=tuple()):
     """Takes a nested dictionary whose keys are strings, and returns a
@@ -113,6 +136,11 @@ def flat_dict_to_flat_series(dictionary):
         (len(item),) + item if isinstance(item, tuple) else (1,item))
     return pandas.Series(result,index=keys)
 
+def get_flat_dict_from_shot(filepath):
+    """Returns the data from a shot as a flat dictionary, ready to be
+    appended to a DataFrameStore"""
+    return flatten_dict(get_nested_dict_from_shot(filepath))
+
 def get_dataframe_from_shot(filepath):
     nested_dict = get_nested_dict_from_shot(filepath)
     flat_dict =  flatten_dict(nested_dict)
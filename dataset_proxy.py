@@ -0,0 +1,104 @@
+#####################################################################
+#                                                                   #
+# /dataset_proxy.py                                                 #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+import contextlib
+
+import numpy as np
+
+
+class DatasetProxy(object):
+    """A lazy reference to a dataset in a shot file, as returned by
+    Run.image(), Run.trace() and Run.result_array(). Nothing is read until
+    the proxy is indexed, and then only the requested part of the dataset
+    (a hyperslab) is read from the file, for example:
+
+        roi = run.image('side', 'absorption', 'atoms')[100:200, 300:400]
+
+    reads only a 100x100 region of the image. Indexing accepts anything
+    h5py datasets do, including field names of compound datasets such as
+    traces, and numpy.array(proxy) reads the whole dataset. Each read opens
+    the file, unless the Run it came from is in use as a context manager,
+    in which case its open file is used.
+
+    The shape and datatype of the dataset are read when the proxy is made.
+    """
+
+    def __init__(self, run, dataset_path):
+        self.run = run
+        self.h5_path = run.h5_path
+        self.dataset_path = dataset_path
+        with self._open() as dataset:
+            self.shape = dataset.shape
+            self.dtype = dataset.dtype
+
+    @contextlib.contextmanager
+    def _open(self):
+        with self.run._file() as h5_file:
+            try:
+                dataset = h5_file[self.dataset_path]
+            except KeyError:
+                raise Exception('%s not found in %s' % (self.dataset_path, self.h5_path))
+            yield dataset
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        with self._open() as dataset:
+            return dataset[key]
+
+    def __array__(self, dtype=None):
+        with self._open() as dataset:
+            data = dataset[()]
+        if dtype is not None:
+            data = np.asarray(data, dtype=dtype)
+        return data
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        """Read part or all of the dataset directly into an existing array,
+        as h5py.Dataset.read_direct() does"""
+        with self._open() as dataset:
+            dataset.read_direct(dest, source_sel, dest_sel)
+
+    def memmap(self):
+        """Return a read-only numpy.memmap of the dataset's data in the shot
+        file, so that reading part of it reads only that part from disk, with
+        no HDF5 overhead at all. Only possible for datasets that are stored
+        contiguously, uncompressed, with a fixed size datatype, which is the
+        default for datasets written without chunking or compression options.
+        Raises ValueError otherwise.
+
+        The map bypasses HDF5 and the file lock, so it must not be used whilst
+        the dataset may be being rewritten, for example by reanalysis of the
+        shot."""
+        with self._open() as dataset:
+            if dataset.chunks is not None or dataset.dtype.hasobject:
+                raise ValueError('%s is chunked or has a variable length datatype, '
+                                 'and so cannot be memory-mapped' % self.dataset_path)
+            offset = dataset.id.get_offset()
+            if offset is None:
+                raise ValueError('%s has no data stored, and so cannot be memory-mapped' % self.dataset_path)
+        return np.memmap(self.h5_path, dtype=self.dtype, mode='r', offset=offset, shape=self.shape)
+
+    def __repr__(self):
+        return '<DatasetProxy %s in %s, shape %s, dtype %s>' % (self.dataset_path, self.h5_path,
+                                                               self.shape, self.dtype)
+
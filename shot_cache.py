@@ -0,0 +1,122 @@
+#####################################################################
+#                                                                   #
+# /shot_cache.py                                                    #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+import os
+import sqlite3
+import threading
+import cPickle as pickle
+
+import labscript_utils.shared_drive
+
+from lyse.dataframe_utilities import get_flat_dict_from_shot
+
+
+class ShotMetadataCache(object):
+    """A persistent, on-disk cache of the flattened data read from shot files
+    by dataframe_utilities.get_flat_dict_from_shot(), so that shots that have
+    been loaded before do not need to be opened and walked again. Entries are
+    stored in an SQLite database, keyed by the shot's agnostic path, and are
+    only used if the file's modification time and size are unchanged.
+
+    The modification time has limited resolution, so a shot rewritten in
+    place soon after being read may look unchanged. Shots known to have been
+    written to, such as after an analysis routine has run, should therefore
+    be read with refresh=True, which ignores and replaces any existing entry.
+
+    At most max_entries shots are kept, and the least recently written
+    entries are deleted beyond that.
+
+    All methods are thread-safe."""
+
+    # How many entries may be written between deletions of old entries:
+    EVICTION_INTERVAL = 1000
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS shots '
+                                    '(agnostic_path TEXT PRIMARY KEY, mtime REAL, size INTEGER, row BLOB)')
+        self.hits = 0
+        self.misses = 0
+        self.puts_since_eviction = 0
+        with self.lock:
+            self.evict()
+
+    def stat(self, filepath):
+        """Return the key a shot's data will be stored under. This should be
+        obtained before reading the file, so that if the file is modified
+        during reading, the cache entry will be invalid rather than stale."""
+        stat = os.stat(filepath)
+        agnostic_path = labscript_utils.shared_drive.path_to_agnostic(filepath)
+        return agnostic_path, stat.st_mtime, stat.st_size
+
+    def get(self, key, filepath):
+        """Return the cached data for the given key, or None if there is no
+        valid entry. The filepath in the returned data is set to the one
+        given, since the shared drive may be mounted somewhere different to
+        when the entry was cached."""
+        agnostic_path, mtime, size = key
+        with self.lock:
+            result = self.connection.execute('SELECT mtime, size, row FROM shots WHERE agnostic_path = ?',
+                                             (agnostic_path,)).fetchone()
+            if result is not None and result[0] == mtime and result[1] == size:
+                self.hits += 1
+                row = pickle.loads(str(result[2]))
+                row[('filepath',)] = filepath
+                return row
+            self.misses += 1
+            return None
+
+    def put(self, key, row):
+        agnostic_path, mtime, size = key
+        data = sqlite3.Binary(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO shots VALUES (?, ?, ?, ?)',
+                                        (agnostic_path, mtime, size, data))
+            self.puts_since_eviction += 1
+            if self.puts_since_eviction >= self.EVICTION_INTERVAL:
+                self.evict()
+
+    def evict(self):
+        """Delete the least recently written entries in excess of
+        max_entries. Must be called with self.lock held."""
+        # Replacing an entry gives it a new rowid, larger than all others, so
+        # rowids are in the order the entries were written:
+        with self.connection:
+            self.connection.execute('DELETE FROM shots WHERE rowid <= '
+                                    '(SELECT rowid FROM shots ORDER BY rowid DESC LIMIT 1 OFFSET ?)',
+                                    (self.max_entries,))
+        self.puts_since_eviction = 0
+
+    def get_flat_dict_from_shot(self, filepath, refresh=False):
+        """Equivalent to dataframe_utilities.get_flat_dict_from_shot(), but
+        using the cache if possible. If refresh is True, the file is read
+        regardless, and the cache entry replaced."""
+        key = self.stat(filepath)
+        row = None if refresh else self.get(key, filepath)
+        if row is None:
+            row = get_flat_dict_from_shot(filepath)
+            self.put(key, row)
+        return row
+
+    def reset_stats(self):
+        """Return the number of hits and misses so far, and reset them to
+        zero"""
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+            return hits, misses
@@ -0,0 +1,45 @@
+import unittest
+
+import numpy as np
+import pandas
+
+from lyse.cache import Cache, sizeof
+
+
+class OldPandasDataFrame(pandas.DataFrame):
+    """A DataFrame whose memory_usage() doesn't accept deep=True, as in
+    older versions of pandas"""
+
+    @property
+    def _constructor(self):
+        return OldPandasDataFrame
+
+    def memory_usage(self, index=True):
+        return pandas.DataFrame.memory_usage(self, index=index)
+
+
+class SizeofTests(unittest.TestCase):
+
+    def test_dataframe(self):
+        df = pandas.DataFrame({'x': np.zeros(1000), 'y': np.zeros(1000)})
+        self.assertGreaterEqual(sizeof(df), 16000)
+
+    def test_dataframe_without_deep_memory_usage(self):
+        df = OldPandasDataFrame({'x': np.zeros(1000), 'y': np.zeros(1000)})
+        self.assertRaises(TypeError, df.memory_usage, deep=True)
+        self.assertGreaterEqual(sizeof(df), 16000)
+
+    def test_dataframes_count_towards_maxbytes(self):
+        for frame_type in [pandas.DataFrame, OldPandasDataFrame]:
+            cache = Cache(maxbytes=20000)
+            cache['a'] = frame_type({'x': np.zeros(1000)})
+            cache['b'] = frame_type({'x': np.zeros(1000)})
+            self.assertIn('b', cache)
+            cache['c'] = frame_type({'x': np.zeros(1000)})
+            self.assertNotIn('a', cache)
+            self.assertEqual(cache.evictions, 1)
+            self.assertLessEqual(cache.nbytes, cache.maxbytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#####################################################################
+#                                                                   #
+# /zmq_server.py                                                    #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+import sys
+import time
+import threading
+import traceback
+import collections
+import cPickle as pickle
+from Queue import Queue
+
+import zmq
+from zprocess import raise_exception_in_thread
+
+# Number of recent requests of each kind to keep the latencies of, for
+# reporting in get_stats():
+N_LATENCIES = 1000
+
+
+class ThreadPoolZMQServer(object):
+    """A drop-in replacement for zprocess.ZMQServer with the 'pyobj'
+    protocol, that handles requests concurrently. Requests are received on
+    a ROUTER socket, so that clients using zprocess.zmq_get() can't tell the
+    difference, and are handled by a pool of worker threads, which send
+    their replies back through the thread that owns the socket. Requests for
+    which is_immediate() returns True are instead handled as soon as they
+    are received, by that thread, so that they are never held up behind
+    slow requests. These must therefore be quick to handle.
+
+    Subclasses override handler() as for ZMQServer, and optionally
+    is_immediate() and request_name()."""
+
+    def __init__(self, port, n_threads=4, bind_address='tcp://0.0.0.0'):
+        self.port = port
+        self.n_threads = n_threads
+        self.bind_address = bind_address
+        self.context = zmq.Context()
+        self.sock = self.context.socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.bind('%s:%s' % (str(self.bind_address), str(self.port)))
+        # Worker threads send their replies to the mainloop thread through
+        # this socket, since zmq sockets must not be shared between threads:
+        self.replies_address = 'inproc://replies-%d' % id(self)
+        self.replies_sock = self.context.socket(zmq.PULL)
+        self.replies_sock.setsockopt(zmq.LINGER, 0)
+        self.replies_sock.bind(self.replies_address)
+        # Requests waiting for a worker thread, as (envelope, request_data,
+        # received_time) tuples:
+        self.requests = Queue()
+        self.stats_lock = threading.Lock()
+        self.n_busy = 0
+        self.counts = collections.defaultdict(int)
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=N_LATENCIES))
+        self.workers = []
+        for i in range(n_threads):
+            worker = threading.Thread(target=self.worker_loop, name='ZMQ server worker %d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.mainloop_thread = threading.Thread(target=self.mainloop)
+        self.mainloop_thread.daemon = True
+        self.mainloop_thread.start()
+
+    def mainloop(self):
+        poller = zmq.Poller()
+        poller.register(self.sock, zmq.POLLIN)
+        poller.register(self.replies_sock, zmq.POLLIN)
+        while True:
+            try:
+                events = dict(poller.poll())
+                if events.get(self.replies_sock):
+                    self.sock.send_multipart(self.replies_sock.recv_multipart(copy=False), copy=False)
+                if events.get(self.sock):
+                    self.receive_request()
+            except zmq.ContextTerminated:
+                self.sock.close(linger=0)
+                self.replies_sock.close(linger=0)
+                return
+
+    def receive_request(self):
+        received_time = time.time()
+        frames = self.sock.recv_multipart()
+        # The frames are the routing envelope, ending with an empty
+        # delimiter frame, followed by the request:
+        envelope, request = frames[:-1], frames[-1]
+        try:
+            request_data = pickle.loads(request)
+        except Exception:
+            self.sock.send_multipart(envelope + [self.format_exception()])
+            return
+        if self.is_immediate(request_data):
+            self.sock.send_multipart(envelope + [self.handle(request_data, received_time)], copy=False)
+        else:
+            self.requests.put((envelope, request_data, received_time))
+
+    def worker_loop(self):
+        sock = self.context.socket(zmq.PUSH)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.replies_address)
+        try:
+            while True:
+                item = self.requests.get()
+                if item is None:
+                    break
+                envelope, request_data, received_time = item
+                with self.stats_lock:
+                    self.n_busy += 1
+                try:
+                    response = self.handle(request_data, received_time)
+                finally:
+                    with self.stats_lock:
+                        self.n_busy -= 1
+                sock.send_multipart(envelope + [response], copy=False)
+        finally:
+            sock.close(linger=0)
+
+    def handle(self, request_data, received_time):
+        """Call the handler with a request and return the pickled response,
+        recording how long the request took"""
+        try:
+            response = pickle.dumps(self.handler(request_data), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            response = self.format_exception()
+        name = self.request_name(request_data)
+        with self.stats_lock:
+            self.counts[name] += 1
+            self.latencies[name].append(time.time() - received_time)
+        return response
+
+    def format_exception(self):
+        """Return a pickled exception for the client to raise, as
+        ZMQServer does for exceptions raised by the handler. The exception is
+        also raised in a separate thread so that it is logged, and the server
+        keeps running."""
+        exc_info = sys.exc_info()
+        raise_exception_in_thread(exc_info)
+        exception_string = traceback.format_exc()
+        response_data = zmq.ZMQError(
+            'The server had an unhandled exception whilst processing the request:\n%s' % str(exception_string))
+        return pickle.dumps(response_data, pickle.HIGHEST_PROTOCOL)
+
+    def get_stats(self):
+        """Return a dictionary of statistics about the requests handled so
+        far: the number of requests waiting for a worker thread
+        ('queue_depth'), the number being handled ('busy'), and for each kind
+        of request, how many have been handled and the mean, median, 90th
+        percentile and maximum latency in seconds of the most recent ones,
+        from being received to the response being ready"""
+        with self.stats_lock:
+            requests = {}
+            for name, latencies in self.latencies.items():
+                latencies = sorted(latencies)
+                requests[name] = {'count': self.counts[name],
+                                  'mean': sum(latencies) / len(latencies),
+                                  'median': latencies[len(latencies) // 2],
+                                  '90th percentile': latencies[int(0.9 * (len(latencies) - 1))],
+                                  'max': latencies[-1]}
+            return {'queue_depth': self.requests.qsize(), 'busy': self.n_busy,
+                    'threads': self.n_threads, 'requests': requests}
+
+    def shutdown(self):
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.context.term()
+        self.mainloop_thread.join()
+
+    def is_immediate(self, request_data):
+        """To be overridden by subclasses. Whether a request should be
+        handled as soon as it is received rather than by a worker thread"""
+        return False
+
+    def request_name(self, request_data):
+        """To be overridden by subclasses. The name of the kind of request,
+        under which statistics about it are recorded"""
+        if isinstance(request_data, basestring):
+            return request_data
+        return type(request_data).__name__
+
+    def handler(self, request_data):
+        """To be overridden by subclasses. This is an example
+        implementation"""
+        response = 'This is an example ThreadPoolZMQServer. Your request was %s.' % str(request_data)
+        return response